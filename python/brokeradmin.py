@@ -0,0 +1,177 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+
+# A command-line client for brokerlib's management address
+#
+# Usage: python -m brokeradmin [--url URL] COMMAND [ARGS]
+
+from __future__ import print_function
+
+import proton as _proton
+import proton.handlers as _handlers
+import proton.reactor as _reactor
+import sys as _sys
+import uuid as _uuid
+
+_MANAGEMENT_ADDRESS = "$management"
+
+class _RequestHandler(_handlers.MessagingHandler):
+    def __init__(self, conn_url, properties, timeout):
+        super(_RequestHandler, self).__init__()
+
+        self.conn_url = conn_url
+        self.properties = properties
+        self.timeout = timeout
+
+        self.sender = None
+        self.timer = None
+        self.response = None
+        self.error = None
+
+    def on_start(self, event):
+        conn = event.container.connect(self.conn_url, reconnect=False)
+
+        self.sender = event.container.create_sender(conn, _MANAGEMENT_ADDRESS)
+        event.container.create_receiver(conn, None, dynamic=True)
+
+        self.timer = event.container.schedule(self.timeout, self)
+
+    def on_link_opened(self, event):
+        if event.link.is_receiver:
+            request = _proton.Message()
+            request.id = _uuid.uuid4()
+            request.reply_to = event.receiver.remote_source.address
+            request.properties = self.properties
+
+            self.sender.send(request)
+
+    def on_message(self, event):
+        self.response = event.message
+
+        self.timer.cancel()
+        event.connection.close()
+
+    def on_timer_task(self, event):
+        self.fail(event, "Timed out waiting for a response from '{0}'".format(self.conn_url))
+
+    def on_transport_error(self, event):
+        self.fail(event, _describe(event.transport.condition, "Failed to connect to '{0}'".format(self.conn_url)))
+
+    def on_connection_error(self, event):
+        self.fail(event, _describe(event.connection.remote_condition, "The connection was closed"))
+
+    def on_link_error(self, event):
+        self.fail(event, _describe(event.link.remote_condition, "The link was closed"))
+
+    def fail(self, event, error):
+        if self.error is None:
+            self.error = error
+
+        event.container.stop()
+
+def _describe(condition, default):
+    if condition is None:
+        return default
+
+    return "{0}: {1}".format(default, condition.description or condition.name)
+
+def _request(conn_url, properties, timeout=10):
+    handler = _RequestHandler(conn_url, properties, timeout)
+    _reactor.Container(handler).run()
+
+    if handler.error is not None:
+        _sys.exit("Error! {0}".format(handler.error))
+
+    response = handler.response
+
+    if response is None:
+        _sys.exit("Error! The broker sent no response")
+
+    properties = response.properties or dict()
+    status = properties.get("status-code")
+
+    if status != 200:
+        _sys.exit("Error! {0}".format(properties.get("status-description", "The broker sent a malformed response")))
+
+    return response.body
+
+def _print_queues(queues):
+    columns = ("address", "depth", "bytes", "consumers", "browsers", "unsettled")
+
+    print("{0:<40} {1:>10} {2:>12} {3:>10} {4:>10} {5:>10}".format(*[x.upper() for x in columns]))
+
+    for queue in queues:
+        print("{0:<40} {1:>10} {2:>12} {3:>10} {4:>10} {5:>10}".format(*[queue[x] for x in columns]))
+
+def _print_fields(fields):
+    for name in sorted(fields):
+        print("{0:<14} {1}".format("{0}:".format(name), fields[name]))
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Administer the queues of a running brokerlib broker")
+    parser.add_argument("--url", metavar="URL", default="localhost:5672",
+                        help="Connect to the broker at URL (default localhost:5672)")
+    parser.add_argument("--timeout", metavar="SECONDS", default=10, type=float,
+                        help="Fail if the broker hasn't responded after SECONDS (default 10)")
+
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    subparsers.required = True
+
+    subparsers.add_parser("list", help="List the queues with their depth, size, and consumers")
+
+    stats = subparsers.add_parser("stats", help="Show broker-wide totals, or the stats for one queue")
+    stats.add_argument("queue", metavar="QUEUE", nargs="?")
+
+    purge = subparsers.add_parser("purge", help="Remove all queued messages from QUEUE")
+    purge.add_argument("queue", metavar="QUEUE")
+
+    move = subparsers.add_parser("move", help="Move messages from QUEUE to TARGET")
+    move.add_argument("queue", metavar="QUEUE")
+    move.add_argument("target", metavar="TARGET")
+    move.add_argument("--count", metavar="COUNT", type=int,
+                      help="Move at most COUNT messages (default all)")
+
+    delete = subparsers.add_parser("delete", help="Delete QUEUE and its messages")
+    delete.add_argument("queue", metavar="QUEUE")
+
+    args = parser.parse_args()
+
+    properties = {"operation": args.command}
+
+    for name in ("queue", "target", "count"):
+        value = getattr(args, name, None)
+
+        if value is not None:
+            properties[name] = value
+
+    body = _request(args.url, properties, args.timeout)
+
+    if args.command == "list":
+        _print_queues(body)
+    else:
+        _print_fields(body)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
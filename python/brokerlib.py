@@ -18,21 +18,80 @@
 #
 
 import collections as _collections
+import gzip as _gzip
+import heapq as _heapq
+import itertools as _itertools
+import math as _math
 import os as _os
 import proton as _proton
 import proton.handlers as _handlers
 import proton.reactor as _reactor
+import proton._handlers as _proton_handlers
+import proton._reactor as _proton_reactor
 import uuid as _uuid
 import shutil as _shutil
+import signal as _signal
+import socket as _socket
+import stat as _stat
+import struct as _struct
 import subprocess as _subprocess
 import sys as _sys
 import time as _time
 import tempfile as _tempfile
 
+# AMQP 1.0 transaction control bodies and delivery states
+_DECLARE = (_proton.symbol("amqp:declare:list"), _proton.ulong(0x31))
+_DISCHARGE = (_proton.symbol("amqp:discharge:list"), _proton.ulong(0x32))
+_DECLARED = 0x33
+_TRANSACTIONAL_STATE = 0x34
+
+# AMQP 1.0 message section descriptor codes
+_HEADER = 0x70
+_DELIVERY_ANNOTATIONS = 0x71
+_MESSAGE_ANNOTATIONS = 0x72
+_PROPERTIES = 0x73
+_APPLICATION_PROPERTIES = 0x74
+
+# The address a primary broker uses to replicate to its backup
+_REPLICATION_ADDRESS = "$replication"
+
+# The address for queue administration requests.  The operation and
+# its arguments are application properties of the request.
+_MANAGEMENT_ADDRESS = "$management"
+_MANAGEMENT_OPERATIONS = ("list", "stats", "purge", "move", "delete")
+
+# Capture files start with the magic bytes.  Each record is a record
+# type, a connection number, the time in seconds since the capture
+# started, and a length-prefixed frame.  Use read_capture to read
+# them.
+CAPTURE_MAGIC = b"BROKERLIB-CAPTURE-1\n"
+CAPTURE_RECORD = _struct.Struct(">BIdI")
+CAPTURE_OPEN = 0
+CAPTURE_FRAME = 1
+CAPTURE_CLOSE = 2
+
+# --capture and unix: listeners rely on parts of proton's Python I/O
+# layer that are not public API.  They are enabled only for the
+# python-qpid-proton releases they were tested with, first to last.
+_PROTON_IO_VERSIONS = (0, 40), (0, 40)
+
+# The smallest credit window granted to a producer link
+_MIN_CREDIT_WINDOW = 10
+
+# Message annotations that hold a message until a later time, as an
+# absolute time or a delay, both in milliseconds
+_DELIVERY_TIME = "x-opt-delivery-time"
+_DELIVERY_DELAY = "x-opt-delivery-delay"
+
 class Broker:
     def __init__(self, host, port, id=None, ready_file=None,
                  user=None, password=None,
                  cert=None, key=None, trust=None,
+                 queue_options=None,
+                 profile=False, profile_interval=10, profile_output=None,
+                 replicate_to=None, backup=False,
+                 max_link_credit=1000, max_total_credit=10000,
+                 max_memory=None, listen=None, capture=None,
                  quiet=False, verbose=False, debug_enabled=False,
                  init_only=False):
         self.host = host
@@ -44,6 +103,12 @@ class Broker:
         self.cert = cert
         self.key = key
         self.trust = trust
+        self.queue_options = queue_options
+        self.backup = backup
+        self.max_link_credit = max_link_credit
+        self.max_total_credit = max_total_credit
+        self.max_memory = max_memory
+        self.listen = listen
         self.quiet = quiet
         self.verbose = verbose
         self.debug_enabled = debug_enabled
@@ -52,7 +117,31 @@ class Broker:
         if self.id is None:
             self.id = "broker-{0}".format(_uuid.uuid4().hex[:8])
 
-        self.container = _reactor.Container(_Handler(self))
+        if self.queue_options is None:
+            self.queue_options = dict()
+
+        self.profiler = None
+
+        if profile:
+            self.profiler = _Profiler(self, profile_interval, profile_output)
+
+        self.capture = None
+
+        if capture is not None:
+            self.capture = _Capture(self, capture)
+
+        self.replicator = None
+
+        if replicate_to is not None:
+            self.replicator = _Replicator(self, replicate_to)
+
+        self.scheduler = _Scheduler(self)
+
+        # The encoded size of all queued messages
+        self.queued_bytes = 0
+
+        self.handler = _Handler(self)
+        self.container = _reactor.Container(self.handler)
         self.container.container_id = self.id # XXX Obnoxious
 
         if self.debug_enabled:
@@ -121,6 +210,14 @@ class Broker:
         self.error(message, *args)
         _sys.exit(1)
 
+    def check_proton_io(self, option):
+        first, last = _PROTON_IO_VERSIONS
+        version = _proton.VERSION[:2]
+
+        if not first <= version <= last:
+            self.fail("{0} relies on proton internals and was tested only with python-qpid-proton "
+                      "{1}.{2} to {3}.{4}, not {5}.{6}", option, *(first + last + version))
+
     def log(self, message, *args):
         message = message[0].upper() + message[1:]
         message = message.format(*args)
@@ -134,6 +231,16 @@ class Broker:
             if self.init_only:
                 return
 
+            if self.profiler is not None:
+                self.profiler.start()
+
+            if any(x.startswith("unix:") for x in self.listen or ()):
+                self.check_proton_io("Listening on unix:PATH")
+
+            if self.capture is not None:
+                self.check_proton_io("--capture")
+                self.capture.open()
+
             self.container.run()
         except OSError as e:
             if self.debug_enabled:
@@ -141,16 +248,534 @@ class Broker:
 
             self.fail(e)
         finally:
+            if self.profiler is not None:
+                self.profiler.stop()
+
+            if self.capture is not None:
+                self.capture.close()
+
+            for acceptor in self.handler.acceptors:
+                if isinstance(acceptor, _UnixAcceptor):
+                    acceptor.remove_socket()
+
             if self._config_dir and _os.path.exists(self._config_dir):
                 _shutil.rmtree(self.dir, ignore_errors=True)
 
+class _Profiler:
+    # Times each handler event callback and queue dispatch.  Nothing
+    # is wrapped unless profiling is enabled.
+
+    def __init__(self, broker, interval, output=None):
+        self.broker = broker
+        self.interval = interval
+        self.output = output
+
+        self.stats = dict()
+
+        self._profile = None
+        self._samples = None
+        self._sampler = None
+
+    def instrument(self, handler):
+        for name in dir(handler):
+            if name.startswith("on_") and callable(getattr(handler, name)):
+                setattr(handler, name, self.wrap(name, getattr(handler, name)))
+
+    def wrap(self, name, function):
+        # Per name: count, total seconds, and max seconds
+        stats = self.stats.setdefault(name, [0, 0.0, 0.0])
+        clock = _time.perf_counter
+
+        def wrapper(*args):
+            start = clock()
+
+            try:
+                return function(*args)
+            finally:
+                elapsed = clock() - start
+
+                stats[0] += 1
+                stats[1] += elapsed
+
+                if elapsed > stats[2]:
+                    stats[2] = elapsed
+
+        return wrapper
+
+    def start(self):
+        if self.output is None:
+            return
+
+        if self.output.endswith(".prof"):
+            import cProfile
+
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            import threading
+
+            self._samples = _collections.Counter()
+            self._sampler = threading.Thread(target=self._sample, args=(threading.current_thread().ident,))
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def stop(self):
+        if self._profile is not None:
+            self._profile.disable()
+
+        self.write()
+        self.log_summary()
+
+        self._profile = None
+        self._samples = None
+
+    def _sample(self, ident):
+        # Collapsed stacks for flame graphs, one sample per millisecond
+
+        while self._samples is not None:
+            frame = _sys._current_frames().get(ident)
+            stack = list()
+
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{0} ({1}:{2})".format(code.co_name, _os.path.basename(code.co_filename),
+                                                    code.co_firstlineno))
+                frame = frame.f_back
+
+            if stack:
+                self._samples[";".join(reversed(stack))] += 1
+
+            _time.sleep(0.001)
+
+    def write(self):
+        if self._profile is not None:
+            # dump_stats disables the profiler
+            self._profile.dump_stats(self.output)
+            self._profile.enable()
+        elif self._samples is not None:
+            with open(self.output, "w") as f:
+                for stack, count in list(self._samples.items()):
+                    f.write("{0} {1}\n".format(stack, count))
+
+    def log_summary(self):
+        lines = ["{0:24} {1:>10} {2:>12} {3:>10} {4:>10}".format("EVENT", "COUNT", "TOTAL (ms)", "MEAN (us)", "MAX (us)")]
+
+        for name, (count, total, max_) in sorted(self.stats.items(), key=lambda x: -x[1][1]):
+            if count == 0:
+                continue
+
+            lines.append("{0:24} {1:>10} {2:>12.1f} {3:>10.1f} {4:>10.1f}".format
+                         (name, count, total * 1000, total / count * 1000000, max_ * 1000000))
+
+        self.broker.log("Profile summary:\n{0}", "\n".join(lines))
+
+    def on_timer_task(self, event):
+        self.log_summary()
+        self.write()
+
+        event.container.schedule(self.interval, self)
+
+class _Capture:
+    # Records the inbound frames of accepted connections.  A file
+    # name ending in .gz is gzip compressed.  The file is flushed
+    # every second, so little is lost if the broker is killed.
+
+    def __init__(self, broker, path, flush_interval=1):
+        self.broker = broker
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self.file = None
+        self.connections = _itertools.count()
+        self.start_time = None
+
+    def open(self):
+        if self.path.endswith(".gz"):
+            self.file = _gzip.open(self.path, "wb")
+        else:
+            self.file = open(self.path, "wb")
+
+        self.file.write(CAPTURE_MAGIC)
+        self.start_time = _time.time()
+
+    def close(self):
+        self.file.close()
+
+    def attach(self, connection, transport):
+        # Puts a recording socket in place of the socket of an accepted
+        # connection, before anything has been read from it.  Proton
+        # has no public hook for this, so it is done through the
+        # selectable proton keeps for the transport.  TLS connections
+        # are not captured, as their frames are encrypted.
+
+        acceptor = getattr(connection, "_acceptor", None)
+
+        if acceptor is None or acceptor._ssl_domain is not None:
+            return
+
+        selectable = transport._selectable
+        selectable._delegate = _CapturingSocket(self, next(self.connections), selectable._delegate)
+
+    def write(self, type, connection, frame=b""):
+        self.file.write(CAPTURE_RECORD.pack(type, connection, _time.time() - self.start_time, len(frame)))
+        self.file.write(frame)
+
+    def on_timer_task(self, event):
+        self.file.flush()
+
+        event.container.schedule(self.flush_interval, self)
+
+class _CapturingSocket:
+    # Stands in for an accepted socket and records each complete
+    # inbound frame.  Protocol headers are recorded as frames of
+    # their own.
+
+    def __init__(self, capture, connection, sock):
+        self.capture = capture
+        self.connection = connection
+        self.sock = sock
+        self.buffer = bytearray()
+
+        self.capture.write(CAPTURE_OPEN, self.connection)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+
+        self.buffer += data
+        self.record_frames()
+
+        return data
+
+    def record_frames(self):
+        buffer = self.buffer
+        offset = 0
+
+        while len(buffer) - offset >= 8:
+            if buffer[offset:offset + 4] == b"AMQP":
+                end = offset + 8
+            else:
+                end = offset + int.from_bytes(buffer[offset:offset + 4], "big")
+
+            if end > len(buffer) or end - offset < 8:
+                break
+
+            self.capture.write(CAPTURE_FRAME, self.connection, bytes(buffer[offset:end]))
+            offset = end
+
+        del buffer[:offset]
+
+    def close(self):
+        self.capture.write(CAPTURE_CLOSE, self.connection)
+        self.sock.close()
+
+def read_capture(path):
+    # Yields the records of a capture file as tuples of record type,
+    # connection number, time, and frame.  A file cut short because
+    # the broker was killed is read up to the last complete record.
+
+    opener = _gzip.open if path.endswith(".gz") else open
+
+    with opener(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("{0} is not a brokerlib capture file".format(path))
+
+        while True:
+            try:
+                header = f.read(CAPTURE_RECORD.size)
+
+                if len(header) < CAPTURE_RECORD.size:
+                    return
+
+                type, connection, time, length = CAPTURE_RECORD.unpack(header)
+                frame = f.read(length)
+            except EOFError:
+                return
+
+            if len(frame) < length:
+                return
+
+            yield type, connection, time, frame
+
+class _Replicator(_handlers.MessagingHandler):
+    # Streams enqueue and dequeue events to a backup broker.  Events
+    # are sent in batches, one message per batch, when the batch is
+    # full or after a short delay.
+    #
+    # A producer's delivery is accepted only after the backup settles
+    # the batch carrying its events, so an accepted message is on both
+    # brokers.  While the backup is away, deliveries are accepted
+    # without waiting, and the backup gets a snapshot when it returns.
+    # Transactional enqueues are replicated at commit, after the
+    # producer's delivery is settled.
+
+    def __init__(self, broker, url, batch_size=1000, batch_delay=0.005):
+        super(_Replicator, self).__init__()
+
+        self.broker = broker
+        self.url = url
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+
+        self.serials = _itertools.count(1)
+        self.events = list()
+        self.start_time = None
+        self.held = list() # Producer deliveries waiting on the current batch
+        self.batches = dict() # Batch delivery => held producer deliveries
+
+        self.container = None
+        self.queues = None
+        self.sender = None
+        self.timer = None
+        self.connected = False
+
+    def start(self, container, queues):
+        self.container = container
+        self.queues = queues
+
+        conn = container.connect(self.url, handler=self)
+        self.sender = container.create_sender(conn, _REPLICATION_ADDRESS)
+
+    def enqueue(self, queue, message):
+        if message.serial is None:
+            message.serial = next(self.serials)
+
+        self.add_event(["enqueue", queue.address, message.serial, message.data])
+
+    def dequeue(self, queue, message):
+        self.add_event(["dequeue", queue.address, message.serial])
+
+    def hold(self, delivery):
+        # Returns true if the delivery is accepted later, when the
+        # backup has the current batch
+        if not self.connected or not self.events:
+            return False
+
+        self.held.append(delivery)
+
+        return True
+
+    def release(self, deliveries):
+        for delivery in deliveries:
+            if not delivery.settled:
+                self.accept(delivery)
+
+    def add_event(self, event):
+        # While the backup is away, events are not kept.  It gets a
+        # snapshot when it returns.
+        if not self.connected:
+            return
+
+        if not self.events:
+            self.start_time = _time.time()
+            self.timer = self.container.schedule(self.batch_delay, self)
+
+        self.events.append(event)
+
+        if len(self.events) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.events or self.sender.credit == 0:
+            return
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        delivery = self.sender.send(_proton.Message([self.start_time, self.events]))
+
+        self.batches[delivery] = self.held
+        self.events = list()
+        self.held = list()
+
+    def snapshot(self):
+        self.events = [["reset"]]
+        self.start_time = _time.time()
+
+        for queue in self.queues.values():
+            for unsettled in queue.unsettled.values():
+                for message in unsettled.values():
+                    self.enqueue(queue, message)
+
+            for message in queue.messages:
+                self.enqueue(queue, message)
+
+        self.flush()
+
+    def on_link_opened(self, event):
+        self.broker.notice("Replicating to backup at '{0}'", self.url)
+
+        self.connected = True
+        self.snapshot()
+
+    def on_sendable(self, event):
+        self.flush()
+
+    def on_timer_task(self, event):
+        self.timer = None
+        self.flush()
+
+    def on_settled(self, event):
+        self.release(self.batches.pop(event.delivery, ()))
+
+    def on_disconnected(self, event):
+        if self.connected:
+            self.broker.warn("Lost the connection to backup at '{0}'", self.url)
+
+        self.connected = False
+        self.events = list()
+
+        for held in self.batches.values():
+            self.release(held)
+
+        self.release(self.held)
+
+        self.batches = dict()
+        self.held = list()
+
+class _Scheduler:
+    # Messages with a future delivery time wait in a heap ordered by
+    # deadline.  One container timer is kept armed for the earliest
+    # deadline.  A new deadline only moves the timer if it is earlier
+    # by more than slack, so a burst of schedules doesn't cancel and
+    # replace the timer each time.  Such messages are at most slack
+    # seconds late.
+    #
+    # Scheduled messages count toward the broker's queued bytes, and
+    # they are replicated when they are scheduled.  A backup that takes
+    # over schedules them again.  A message with a delivery delay,
+    # rather than a delivery time, is then delayed again from the
+    # takeover.
+
+    def __init__(self, broker, slack=0.01):
+        self.broker = broker
+        self.slack = slack
+        self.heap = list()
+        self.sequence = _itertools.count()
+        self.task = None
+        self.task_time = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, queue, message):
+        # Returns false if the message is due now
+
+        now = _time.time()
+        deadline = message.get_delivery_time(now)
+
+        if deadline is None or deadline <= now:
+            return False
+
+        message.trim()
+
+        _heapq.heappush(self.heap, (deadline, next(self.sequence), queue, message))
+        self.broker.queued_bytes += len(message.data)
+
+        if self.broker.replicator is not None:
+            self.broker.replicator.enqueue(queue, message)
+
+        if self.task_time is None or deadline < self.task_time - self.slack:
+            self.arm(deadline, now)
+
+        return True
+
+    def arm(self, deadline, now):
+        if self.task is not None:
+            self.task.cancel()
+
+        self.task = self.broker.container.schedule(max(deadline - now, 0), self)
+        self.task_time = deadline
+
+    def cancel(self, queue):
+        # Drops the messages scheduled for queue
+
+        heap = list()
+
+        for item in self.heap:
+            if item[2] is queue:
+                self.broker.queued_bytes -= len(item[3].data)
+                queue.acknowledge(item[3])
+            else:
+                heap.append(item)
+
+        if len(heap) != len(self.heap):
+            _heapq.heapify(heap)
+            self.heap = heap
+
+    def on_timer_task(self, event):
+        self.task = None
+        self.task_time = None
+
+        now = _time.time()
+        queues = dict()
+
+        while self.heap and self.heap[0][0] <= now:
+            _, _, queue, message = _heapq.heappop(self.heap)
+
+            self.broker.queued_bytes -= len(message.data)
+            queue.enqueue(message)
+            queues[queue.address] = queue
+
+        for queue in queues.values():
+            queue.forward_messages()
+
+        if self.heap:
+            self.arm(self.heap[0][0], now)
+
 class _Queue:
     def __init__(self, broker, address):
         self.broker = broker
         self.address = address
 
-        self.messages = _collections.deque()
+        self.messages = _MessageList()
         self.consumers = _collections.deque()
+        self.unsettled = dict()
+
+        # The encoded size of the queued messages
+        self.bytes = 0
+
+        # Browsers map to a cursor, the position of the next message
+        # they will see.  Positions count from the first message ever
+        # stored, and messages[0] is at position self.offset.
+        #
+        # Returned messages go back in front of the head and take the
+        # positions just before it, so the offset moves back.  A
+        # browser whose cursor is past those positions has already
+        # seen the messages and does not see them again.  A browser
+        # whose cursor is behind them sees them when they come back.
+        self.browsers = dict()
+        self.offset = 0
+
+        options = self.broker.queue_options.get(address, {})
+
+        self.max_delivery_count = int(options.get("max-delivery-count", 0))
+        self.dead_letter_address = options.get("dead-letter-address")
+
+        # In a last-value queue, a message replaces any queued message
+        # with the same value for the last-value-key application
+        # property
+        self.last_value_key = options.get("last-value-key")
+        self.last_values = dict() # Key => queued message
+        self.last_value_keys = dict() # Queued message => key
+
+        # Messages with an ID seen among the last duplicate-window IDs
+        # are dropped
+        self.duplicates = None
+
+        if "duplicate-window" in options:
+            size = int(options["duplicate-window"])
+            kind = options.get("duplicate-filter", "lru")
+
+            if kind == "lru":
+                self.duplicates = _DuplicateWindow(size)
+            elif kind == "bloom":
+                self.duplicates = _BloomDuplicateWindow(size)
+            else:
+                raise ValueError("Unknown duplicate filter '{0}'".format(kind))
 
         self.broker.info("Created {0}", self)
 
@@ -162,12 +787,25 @@ class _Queue:
         assert link not in self.consumers
 
         self.consumers.append(link)
+        self.unsettled[link] = dict()
 
         self.broker.info("Added consumer for {0} to {1}", _container_repr(link.connection), self)
 
+    def add_browser(self, link):
+        assert link.is_sender
+        assert link not in self.browsers
+
+        self.browsers[link] = self.offset
+
+        self.broker.info("Added browser for {0} to {1}", _container_repr(link.connection), self)
+
     def remove_consumer(self, link):
         assert link.is_sender
 
+        if self.browsers.pop(link, None) is not None:
+            self.broker.info("Removed browser for {0} from {1}", _container_repr(link.connection), self)
+            return
+
         try:
             self.consumers.remove(link)
         except ValueError:
@@ -175,50 +813,856 @@ class _Queue:
 
         self.broker.info("Removed consumer for {0} from {1}", _container_repr(link.connection), self)
 
+        # Messages the consumer never settled are available again
+        self.requeue(self.unsettled.pop(link).values())
+        self.forward_messages()
+
+    def is_duplicate(self, message):
+        if self.duplicates is None:
+            return False
+
+        id = message.id
+
+        if id is None or not self.duplicates.check(id):
+            return False
+
+        self.broker.notice("Dropped duplicate {0} on {1}", message, self)
+
+        return True
+
     def store_message(self, delivery, message):
-        self.messages.append(message)
+        if self.is_duplicate(message):
+            return
+
+        if self.broker.scheduler.schedule(self, message):
+            self.broker.notice("Scheduled {0} from {1} on {2}", message, _container_repr(delivery.connection), self)
+            return
+
+        self.enqueue(message)
 
         self.broker.notice("Stored {0} from {1} on {2}", message, _container_repr(delivery.connection), self)
 
+    def enqueue(self, message):
+        if self.last_value_key is not None and self.replace_last_value(message):
+            if message.serial is not None:
+                # Replicated while it was scheduled
+                self.acknowledge(message)
+
+            return
+
+        message.trim()
+
+        self.messages.append(message)
+        self.add_bytes(len(message.data))
+
+        if self.broker.replicator is not None:
+            self.broker.replicator.enqueue(self, message)
+
+    def add_bytes(self, count):
+        self.bytes += count
+        self.broker.queued_bytes += count
+
+    def remove_messages(self, count):
+        # Takes up to count messages from the front of the queue
+
+        messages = [self.messages.popleft() for x in range(min(count, len(self.messages)))]
+
+        self.offset += len(messages)
+        self.add_bytes(-sum([len(x.data) for x in messages]))
+
+        if self.last_value_keys:
+            for message in messages:
+                self.remove_last_value(message)
+
+        return messages
+
+    def get_stats(self):
+        return {
+            "address": self.address,
+            "depth": len(self.messages),
+            "bytes": self.bytes,
+            "consumers": len(self.consumers),
+            "browsers": len(self.browsers),
+            "unsettled": sum([len(x) for x in self.unsettled.values()]),
+        }
+
+    def get_last_value_key(self, message):
+        properties = message.get_section(_APPLICATION_PROPERTIES)
+
+        if not properties:
+            return None
+
+        return properties.get(self.last_value_key)
+
+    def replace_last_value(self, message):
+        # Returns true if message took the place of a queued message.
+        # The queued message keeps its slot and takes on the new
+        # content, so the replacement costs no queue traversal.
+
+        key = self.get_last_value_key(message)
+
+        if key is None:
+            return False
+
+        current = self.last_values.get(key)
+
+        if current is None:
+            self.last_values[key] = message
+            self.last_value_keys[message] = key
+
+            return False
+
+        self.acknowledge(current)
+        self.add_bytes(len(message.data) - len(current.data))
+
+        current.replace(message)
+        current.trim()
+
+        if self.broker.replicator is not None:
+            self.broker.replicator.enqueue(self, current)
+
+        self.broker.info("Replaced the value for key '{0}' on {1}", key, self)
+
+        return True
+
+    def remove_last_value(self, message):
+        key = self.last_value_keys.pop(message, None)
+
+        if key is not None:
+            del self.last_values[key]
+
+    def restore_last_value(self, message):
+        # Returns false if a newer value for the message's key is
+        # already queued
+
+        key = self.get_last_value_key(message)
+
+        if key is None:
+            return True
+
+        if key in self.last_values:
+            self.acknowledge(message)
+            return False
+
+        self.last_values[key] = message
+        self.last_value_keys[message] = key
+
+        return True
+
+    def acknowledge(self, message):
+        # The message is gone for good
+
+        if self.broker.replicator is not None:
+            self.broker.replicator.dequeue(self, message)
+
+    def requeue(self, messages):
+        # Returned messages go back to the front, in their original order
+        messages = list(messages)
+
+        if self.last_value_key is not None:
+            # The newest of the returned values for a key is kept
+            messages = [x for x in reversed(messages) if self.restore_last_value(x)]
+            messages.reverse()
+
+        self.messages.extendleft(reversed(messages))
+        self.offset -= len(messages)
+        self.add_bytes(sum([len(x.data) for x in messages]))
+
+    def settle(self, delivery):
+        # Returns the message for a settled delivery, or None if the
+        # delivery is no longer tracked
+        return self.unsettled.get(delivery.link, {}).pop(delivery, None)
+
     def forward_messages(self):
+        # Browsers go first, so they see messages the consumers are
+        # about to take
+        if self.browsers:
+            self.browse_messages()
+
         credit = sum([x.credit for x in self.consumers])
         sent = 0
 
         if credit == 0:
             return
 
-        while sent < credit:
-            for consumer in self.consumers:
-                if consumer.credit == 0:
-                    continue
+        while sent < credit:
+            for consumer in self.consumers:
+                if consumer.credit == 0:
+                    continue
+
+                try:
+                    message = self.messages.popleft()
+                except IndexError:
+                    self.consumers.rotate(sent)
+                    return
+
+                self.offset += 1
+                self.add_bytes(-len(message.data))
+
+                if self.last_value_keys:
+                    self.remove_last_value(message)
+
+                delivery = consumer.send(message)
+                delivery.queue = self
+                delivery.message = message
+                sent += 1
+
+                if delivery.settled:
+                    self.acknowledge(message)
+                else:
+                    self.unsettled[consumer][delivery] = message
+
+                self.broker.notice("Forwarded {0} on {1} to {2}", message, self, _container_repr(consumer.connection))
+
+        self.consumers.rotate(sent)
+
+    def browse_messages(self):
+        for browser, cursor in self.browsers.items():
+            # Messages consumed since the browser's last visit are
+            # skipped
+            start = max(cursor - self.offset, 0)
+            end = min(start + browser.credit, len(self.messages))
+
+            if start >= end:
+                continue
+
+            for index in range(start, end):
+                message = self.messages[index]
+                delivery = browser.send(message)
+                delivery.queue = self
+
+                self.broker.notice("Browsed {0} on {1} for {2}", message, self, _container_repr(browser.connection))
+
+            self.browsers[browser] = self.offset + end
+
+class _BulkTask:
+    # Applies function to count messages from the front of a queue,
+    # a chunk at a time.  The reactor runs other work between chunks,
+    # so a large purge or move does not stall the broker.
+
+    def __init__(self, container, queue, count, function, done, chunk_size=10000):
+        self.container = container
+        self.queue = queue
+        self.count = count
+        self.function = function
+        self.done = done
+        self.chunk_size = chunk_size
+
+        self.total = 0
+
+    def start(self):
+        self.container.schedule(0, self)
+
+    def on_timer_task(self, event):
+        size = min(self.chunk_size, self.count - self.total)
+        messages = self.queue.remove_messages(size)
+
+        self.function(messages)
+        self.total += len(messages)
+
+        if len(messages) == size and self.total < self.count:
+            self.container.schedule(0, self)
+        else:
+            self.done(self.total)
+
+class _MessageList:
+    # A FIFO of messages with constant-time access by index.
+    # Browsers read from the middle of the queue, which costs linear
+    # time per access in a deque.  Taken messages leave empty slots
+    # at the front of a list, and the slots are reclaimed once they
+    # make up half of it.
+
+    def __init__(self):
+        self.items = list()
+        self.head = 0
+
+    def __len__(self):
+        return len(self.items) - self.head
+
+    def __iter__(self):
+        return _itertools.islice(self.items, self.head, None)
+
+    def __getitem__(self, index):
+        assert 0 <= index < len(self), index
+        return self.items[self.head + index]
+
+    def append(self, message):
+        self.items.append(message)
+
+    def popleft(self):
+        if self.head == len(self.items):
+            raise IndexError("pop from an empty list")
+
+        message = self.items[self.head]
+
+        self.items[self.head] = None
+        self.head += 1
+
+        if self.head >= 1024 and self.head * 2 >= len(self.items):
+            del self.items[:self.head]
+            self.head = 0
+
+        return message
+
+    def extendleft(self, messages):
+        # Like deque.extendleft, the messages end up in reverse order.
+        # Empty slots are reused when there are enough of them.
+
+        messages = list(messages)
+        messages.reverse()
+
+        if len(messages) <= self.head:
+            self.items[self.head - len(messages):self.head] = messages
+            self.head -= len(messages)
+        else:
+            self.items[:self.head] = messages
+            self.head = 0
+
+class _AddressTrie:
+    # Indexes wildcard address patterns by word.  Words are separated
+    # by '.', '*' matches exactly one word, and '#' matches zero or
+    # more words.
+
+    def __init__(self, cache_size=10000):
+        self.root = _TrieNode()
+        self.cache = dict()
+        self.cache_size = cache_size
+
+    def add(self, pattern, value):
+        node = self.root
+
+        for word in pattern.split("."):
+            child = node.children.get(word)
+
+            if child is None:
+                child = node.children[word] = _TrieNode()
+
+            node = child
+
+        node.values.append(value)
+        self.cache.clear()
+
+    def remove(self, pattern, value):
+        path = [self.root]
+
+        for word in pattern.split("."):
+            try:
+                path.append(path[-1].children[word])
+            except KeyError:
+                return
+
+        try:
+            path[-1].values.remove(value)
+        except ValueError:
+            return
+
+        # Prune the nodes left empty
+        for parent, word, node in reversed(list(zip(path, pattern.split("."), path[1:]))):
+            if node.children or node.values:
+                break
+
+            del parent.children[word]
+
+        self.cache.clear()
+
+    def match(self, address):
+        try:
+            return self.cache[address]
+        except KeyError:
+            pass
+
+        words = address.split(".")
+        count = len(words)
+        matches = dict()
+        stack = [(self.root, 0)]
+
+        while stack:
+            node, index = stack.pop()
+            children = node.children
+
+            if "#" in children:
+                hash_node = children["#"]
+                stack.extend((hash_node, x) for x in range(index, count + 1))
+
+            if index == count:
+                matches.update((id(x), x) for x in node.values)
+                continue
+
+            word = words[index]
+
+            if word in children:
+                stack.append((children[word], index + 1))
+
+            if "*" in children:
+                stack.append((children["*"], index + 1))
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+
+        result = self.cache[address] = tuple(matches.values())
+
+        return result
+
+class _TrieNode:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = dict()
+        self.values = list()
+
+def _is_wildcard(address):
+    return any(x in ("*", "#") for x in address.split("."))
+
+class _DuplicateWindow:
+    # Remembers the most recently seen size IDs exactly
+
+    def __init__(self, size):
+        self.size = size
+        self.ids = _collections.OrderedDict()
+
+    def check(self, id):
+        # Returns true if id was seen, and records it
+
+        if id in self.ids:
+            self.ids.move_to_end(id)
+            return True
+
+        self.ids[id] = None
+
+        if len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+
+        return False
+
+class _BloomDuplicateWindow:
+    # A pair of Bloom filters, each sized for size IDs.  New IDs go
+    # into the current filter.  When it is full, it becomes the
+    # previous filter and the old previous filter is discarded, so
+    # memory is fixed and the last size to 2 * size IDs are covered.
+    # An unseen ID is reported as seen at the false positive rate.
+
+    def __init__(self, size, false_positive_rate=0.01):
+        self.size = size
+        self.bits = int(-size * _math.log(false_positive_rate) / _math.log(2) ** 2)
+        self.hashes = max(int(round(self.bits / size * _math.log(2))), 1)
+
+        self.current = bytearray((self.bits + 7) // 8)
+        self.previous = bytearray(len(self.current))
+        self.count = 0
+
+    def get_positions(self, id):
+        # Double hashing derives all the positions from two hashes
+        first = hash(id)
+        second = hash((id, self.bits)) | 1
+
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def check(self, id):
+        # Returns true if id was probably seen, and records it
+
+        positions = self.get_positions(id)
+
+        for array in (self.current, self.previous):
+            if all(array[x >> 3] & (1 << (x & 7)) for x in positions):
+                return True
+
+        if self.count == self.size:
+            self.previous = self.current
+            self.current = bytearray(len(self.previous))
+            self.count = 0
+
+        for x in positions:
+            self.current[x >> 3] |= 1 << (x & 7)
+
+        self.count += 1
+
+        return False
+
+class _Message:
+    # Queued messages are kept as encoded bytes with a few fields of
+    # broker state, so deep queues cost little more than their
+    # payload
+
+    __slots__ = ("data", "delivery_count", "serial", "_sections")
+
+    def __init__(self, data):
+        self.data = data
+        self.delivery_count = 0
+        self.serial = None
+
+        self._sections = None
+
+    def __repr__(self):
+        message = _proton.Message()
+        message.decode(self.data)
+
+        return repr(message)
+
+    def copy(self):
+        # Shares the encoded bytes
+        return _Message(self.data)
+
+    def trim(self):
+        # Drops the section offsets cached while routing.  They are
+        # found again if needed.
+        self._sections = None
+
+    def replace(self, other):
+        # Takes on the content of other as a new message
+        self.data = other.data
+        self.delivery_count = other.delivery_count
+        self.serial = None
+
+        self._sections = other._sections
+
+    @property
+    def id(self):
+        properties = self.get_section(_PROPERTIES)
+
+        try:
+            return properties[0]
+        except (IndexError, TypeError):
+            return None
+
+    @property
+    def address(self):
+        properties = self.get_section(_PROPERTIES)
+
+        try:
+            return properties[2]
+        except (IndexError, TypeError):
+            return None
+
+    def get_delivery_time(self, now):
+        annotations = self.get_section(_MESSAGE_ANNOTATIONS)
+
+        if not annotations:
+            return None
+
+        if _DELIVERY_TIME in annotations:
+            return annotations[_DELIVERY_TIME] / 1000.0
+
+        if _DELIVERY_DELAY in annotations:
+            return now + annotations[_DELIVERY_DELAY] / 1000.0
+
+        return None
+
+    def get_section(self, code):
+        if self._sections is None:
+            self._sections = _scan_sections(self.data)
+
+        try:
+            start, end = self._sections[code]
+        except KeyError:
+            return None
+
+        data = _proton.Data()
+        data.decode(self.data[start:end])
+        data.next()
+
+        return data.get_object().value
+
+    def annotate(self, annotations):
+        # Only the message annotations section is re-encoded.  The
+        # remaining sections are carried over as encoded.
+
+        if self._sections is None:
+            self._sections = _scan_sections(self.data)
+
+        merged = self.get_section(_MESSAGE_ANNOTATIONS) or dict()
+        merged.update((_proton.symbol(k), v) for k, v in annotations.items())
+
+        section = _proton.Data()
+        section.put_object(_proton.Described(_proton.ulong(_MESSAGE_ANNOTATIONS), merged))
+
+        try:
+            start, end = self._sections[_MESSAGE_ANNOTATIONS]
+        except KeyError:
+            start = end = max([0] + [self._sections[x][1] for x in (_HEADER, _DELIVERY_ANNOTATIONS)
+                                     if x in self._sections])
+
+        return _Message(self.data[:start] + section.encode() + self.data[end:])
+
+    def send(self, sender, tag=None):
+        # Called by Sender.send.  The stored encoding goes out as is.
+
+        delivery = sender.delivery(tag or sender.delivery_tag())
+
+        sender.stream(self.data)
+        sender.advance()
+
+        if sender.snd_settle_mode == _proton.Link.SND_SETTLED:
+            delivery.settle()
+
+        return delivery
+
+def _copies(message):
+    # The message itself, then copies of it for any further queues
+    yield message
+
+    while True:
+        yield message.copy()
+
+def _scan_sections(data):
+    # Maps section descriptor codes to the start and end offsets of
+    # the first section with that code
+
+    sections = dict()
+    offset = 0
+
+    while offset < len(data):
+        start = offset
+
+        if data[offset] != 0x00:
+            raise ValueError("Message section at offset {0} is not a described type".format(offset))
+
+        if data[offset + 1] == 0x53:
+            code = data[offset + 2]
+        elif data[offset + 1] == 0x80:
+            code = int.from_bytes(data[offset + 2:offset + 10], "big")
+        else:
+            code = None
+
+        offset = _skip_value(data, offset)
+        sections.setdefault(code, (start, offset))
+
+    return sections
+
+_FIXED_WIDTHS = {0x4: 0, 0x5: 1, 0x6: 2, 0x7: 4, 0x8: 8, 0x9: 16}
+
+def _skip_value(data, offset):
+    # Returns the offset just past the encoded value at offset
+
+    code = data[offset]
+    offset += 1
+
+    if code == 0x00:
+        # A described value: the descriptor, then the value
+        return _skip_value(data, _skip_value(data, offset))
+
+    category = code >> 4
+
+    try:
+        return offset + _FIXED_WIDTHS[category]
+    except KeyError:
+        pass
+
+    if category in (0xa, 0xc, 0xe):
+        return offset + 1 + data[offset]
+
+    if category in (0xb, 0xd, 0xf):
+        return offset + 4 + int.from_bytes(data[offset:offset + 4], "big")
+
+    raise ValueError("Unknown type code 0x{0:02x} at offset {1}".format(code, offset - 1))
+
+class _Transaction:
+    def __init__(self, broker, connection):
+        self.broker = broker
+        self.connection = connection
+        self.id = _uuid.uuid4().bytes
+
+        self.enqueues = list()
+        self.acknowledgments = dict()
+
+        self.broker.info("Declared {0}", self)
+
+    def __repr__(self):
+        return "transaction '{0}'".format(_uuid.UUID(bytes=self.id))
+
+    def enqueue(self, queue, message):
+        self.enqueues.append((queue, message))
+
+    def acknowledge(self, delivery, state):
+        self.acknowledgments[delivery] = state
+
+    def commit(self):
+        queues = dict()
+
+        # Apply all the enqueues before dispatching, so each affected
+        # queue forwards its new messages in a single pass
+
+        for queue, message in self.enqueues:
+            if queue.is_duplicate(message):
+                continue
+
+            if not self.broker.scheduler.schedule(queue, message):
+                queue.enqueue(message)
+                queues[queue.address] = queue
+
+        for delivery, state in self.acknowledgments.items():
+            # Released and modified outcomes return the message
+            queue = delivery.queue
+
+            if getattr(state, "descriptor", None) in (delivery.RELEASED, delivery.MODIFIED):
+                queue.requeue([delivery.message])
+                queues[queue.address] = queue
+            else:
+                queue.acknowledge(delivery.message)
+
+            if not delivery.settled:
+                delivery.settle()
+
+        for queue in queues.values():
+            queue.forward_messages()
+
+        self.broker.info("Committed {0} with {1} enqueues and {2} acknowledgments",
+                         self, len(self.enqueues), len(self.acknowledgments))
+
+    def rollback(self):
+        queues = dict()
+
+        # Acknowledged messages go back to their queues
+
+        for delivery in reversed(list(self.acknowledgments)):
+            queue = delivery.queue
+            queue.requeue([delivery.message])
+            queues[queue.address] = queue
+
+            if not delivery.settled:
+                delivery.update(delivery.RELEASED)
+                delivery.settle()
+
+        for queue in queues.values():
+            queue.forward_messages()
+
+        self.broker.info("Rolled back {0} with {1} enqueues and {2} acknowledgments",
+                         self, len(self.enqueues), len(self.acknowledgments))
+
+class _UnixAcceptor(_proton_reactor.Acceptor):
+    # Accepts connections on a Unix domain socket.  Proton's acceptor
+    # only listens on TCP, so this one sets up its own socket and
+    # binds each accepted connection to a transport in the same way.
+    # The socket file is removed when the acceptor is closed and when
+    # the broker stops.
+
+    def __init__(self, container, path):
+        self._ssl_domain = None
+        self._reactor = container
+        self._handler = None
+        self.path = path
+
+        if _os.path.lexists(path):
+            self.remove_stale_socket()
+
+        sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.bind(path)
+        sock.listen(128)
+
+        # Only the file this acceptor created is removed later
+        self.inode = _os.stat(path).st_ino
+
+        selectable = container.selectable(handler=self, delegate=sock)
+        selectable.reading = True
+        selectable._transport = None
+
+        self._selectable = selectable
+        container.update(selectable)
+
+    def remove_stale_socket(self):
+        # A socket file left behind by an earlier broker is replaced.
+        # One that still has a listener is not.
+
+        if not _stat.S_ISSOCK(_os.lstat(self.path).st_mode):
+            raise Exception("'{0}' exists and is not a socket".format(self.path))
+
+        probe = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+
+        try:
+            probe.connect(self.path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            _os.unlink(self.path)
+        else:
+            raise Exception("Another process is listening on '{0}'".format(self.path))
+        finally:
+            probe.close()
+
+    def close(self):
+        super(_UnixAcceptor, self).close()
+        self.remove_socket()
+
+    def remove_socket(self):
+        try:
+            if _os.stat(self.path).st_ino == self.inode:
+                _os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def on_selectable_readable(self, event):
+        sock, _ = self._selectable.accept()
+        sock.setblocking(False)
+
+        container = self._reactor
+
+        connection = container.connection(self._handler or container.handler)
+        connection._acceptor = self
 
-                try:
-                    message = self.messages.popleft()
-                except IndexError:
-                    self.consumers.rotate(sent)
-                    return
+        transport = _proton.Transport(_proton.Transport.SERVER)
+        transport.bind(connection)
 
-                consumer.send(message)
-                sent += 1
+        selectable = container.selectable(delegate=sock)
+        selectable._transport = transport
+        transport._selectable = selectable
 
-                self.broker.notice("Forwarded {0} on {1} to {2}", message, self, _container_repr(consumer.connection))
+        _proton_handlers.IOHandler.update(transport, selectable, container.now)
 
-        self.consumers.rotate(sent)
+class _Producer:
+    __slots__ = ("window", "credit", "starved")
+
+    def __init__(self):
+        self.window = _MIN_CREDIT_WINDOW
+        self.credit = 0 # The link credit at the last update
+        self.starved = False
 
 class _Handler(_handlers.MessagingHandler):
     def __init__(self, broker):
-        super(_Handler, self).__init__()
+        # Credit for producers is managed in update_credit
+        super(_Handler, self).__init__(prefetch=0)
+
+        # Incoming deliveries are read in on_delivery, where they are
+        # kept in their encoded form instead of decoded to messages
+        self.handlers = [x for x in self.handlers if not isinstance(x, _handlers.IncomingMessageHandler)]
 
         self.broker = broker
+        self.acceptors = list()
         self.queues = dict()
+        self.subscriptions = _AddressTrie()
+        self.transactions = dict()
+        self.producers = dict() # Link => _Producer
+        self.starved = _collections.deque() # Producer links waiting for credit
+        self.outstanding_credit = 0
         self.verbose = False
 
+        # Replicated queue contents, by address and serial, while the
+        # broker is a backup
+        self.mirrors = None
+        self.replication_stats = [0, 0, 0.0, 0.0] # Batches, events, total lag, max lag
+
+        if self.broker.backup:
+            self.mirrors = dict()
+
+        if self.broker.profiler is not None:
+            self.broker.profiler.instrument(self)
+
     def on_start(self, event):
-        interface = "{0}:{1}".format(self.broker.host, self.broker.port)
+        if self.broker.profiler is not None:
+            event.container.schedule(self.broker.profiler.interval, self.broker.profiler)
 
-        if self.broker.cert is not None:
-            interface = "amqps://{0}".format(interface)
+        if self.broker.capture is not None:
+            event.container.schedule(self.broker.capture.flush_interval, self.broker.capture)
+
+        if self.broker.replicator is not None:
+            self.broker.replicator.start(event.container, self.queues)
+
+        interfaces = self.broker.listen
 
+        if not interfaces:
+            interfaces = ["{0}:{1}".format(self.broker.host, self.broker.port)]
+
+            if self.broker.cert is not None:
+                interfaces = ["amqps://{0}".format(interfaces[0])]
+
+        if self.broker.cert is not None:
             ssl_domain = event.container.ssl.server
             ssl_domain.set_credentials(self.broker.cert, self.broker.key, None)
 
@@ -228,9 +1672,20 @@ class _Handler(_handlers.MessagingHandler):
             else:
                 ssl_domain.set_peer_authentication(_proton.SSLDomain.ANONYMOUS_PEER)
 
-        self.acceptor = event.container.listen(interface)
+        self.acceptors = list()
+
+        # All the listeners share one queue space
+        for interface in interfaces:
+            if interface.startswith("unix:"):
+                acceptor = _UnixAcceptor(event.container, interface[len("unix:"):])
+            elif interface.startswith("amqps:") and self.broker.cert is None:
+                raise Exception("Listening on '{0}' requires --cert and --key".format(interface))
+            else:
+                acceptor = event.container.listen(interface)
+
+            self.acceptors.append(acceptor)
 
-        self.broker.notice("Listening for connections on '{0}'", interface)
+            self.broker.notice("Listening for connections on '{0}'", interface)
 
         if self.broker.ready_file is not None:
             with open(self.broker.ready_file, "w") as f:
@@ -249,9 +1704,41 @@ class _Handler(_handlers.MessagingHandler):
 
         queue = _Queue(self.broker, address)
         self.queues[address] = queue
+
+        if self.broker.profiler is not None:
+            queue.forward_messages = self.broker.profiler.wrap("forward_messages", queue.forward_messages)
+
+        if _is_wildcard(address):
+            self.subscriptions.add(address, queue)
+
         return queue
 
+    def route(self, address):
+        # The queue for the address itself, then any wildcard
+        # subscriptions matching it.  The address queue is only
+        # created when no subscription takes the message.
+        queue = self.queues.get(address)
+        subscriptions = [x for x in self.subscriptions.match(address) if x is not queue]
+
+        if queue is None and not subscriptions:
+            queue = self.create_queue(address)
+
+        if queue is None:
+            return subscriptions
+
+        return [queue] + subscriptions
+
     def on_link_opening(self, event):
+        if event.link.is_receiver and event.link.remote_target.address == _REPLICATION_ADDRESS:
+            self.on_replication_link_opening(event)
+            return
+
+        if self.mirrors is not None:
+            # Until promoted, a backup sends clients elsewhere
+            event.connection.condition = _proton.Condition("amqp:connection:forced", "This broker is a backup")
+            event.connection.close()
+            return
+
         if event.link.is_sender:
             # A client receiving from the broker
 
@@ -269,11 +1756,22 @@ class _Handler(_handlers.MessagingHandler):
             assert address is not None
 
             event.link.source.address = address
-            queue.add_consumer(event.link)
+
+            if event.link.remote_source.distribution_mode == _proton.Terminus.DIST_MODE_COPY:
+                # A non-destructive browser
+                event.link.source.distribution_mode = _proton.Terminus.DIST_MODE_COPY
+                queue.add_browser(event.link)
+            else:
+                queue.add_consumer(event.link)
 
         if event.link.is_receiver:
             # A client sending to the broker
 
+            if event.link.remote_target.type == _proton.Terminus.COORDINATOR:
+                # A transaction coordinator
+                event.link.target.copy(event.link.remote_target)
+                return
+
             if event.link.remote_target.dynamic:
                 # A temporary queue
                 address = "{0}/{1}".format(event.connection.remote_container, event.link.name)
@@ -281,6 +1779,9 @@ class _Handler(_handlers.MessagingHandler):
             elif event.link.remote_target.address in (None, ""):
                 # Anonymous relay - no queueing
                 address = None
+            elif event.link.remote_target.address == _MANAGEMENT_ADDRESS:
+                # Administration requests - no queueing
+                address = _MANAGEMENT_ADDRESS
             else:
                 # A named queue
                 address = event.link.remote_target.address
@@ -288,11 +1789,237 @@ class _Handler(_handlers.MessagingHandler):
 
             event.link.target.address = address
 
+    def on_replication_link_opening(self, event):
+        if self.mirrors is None:
+            event.link.condition = _proton.Condition("amqp:not-allowed", "This broker is not a backup")
+            event.link.close()
+            return
+
+        self.broker.notice("Receiving replication from {0}", _container_repr(event.connection))
+
+        event.link.target.address = _REPLICATION_ADDRESS
+        event.connection.replication = True
+
+    def on_replication_message(self, event):
+        message = _proton.Message()
+        message.decode(event.message.data)
+
+        start_time, events = message.body
+
+        for item in events:
+            kind = item[0]
+
+            if kind == "enqueue":
+                address, serial, data = item[1:]
+
+                try:
+                    mirror = self.mirrors[address]
+                except KeyError:
+                    mirror = self.mirrors[address] = _collections.OrderedDict()
+
+                mirror[serial] = bytes(data)
+            elif kind == "dequeue":
+                address, serial = item[1:]
+                self.mirrors.get(address, {}).pop(serial, None)
+            elif kind == "reset":
+                self.mirrors.clear()
+
+        lag = _time.time() - start_time
+        stats = self.replication_stats
+
+        stats[0] += 1
+        stats[1] += len(events)
+        stats[2] += lag
+        stats[3] = max(stats[3], lag)
+
+        self.broker.info("Applied {0} replicated events with a lag of {1:.1f} ms", len(events), lag * 1000)
+
+        self.accept(event.delivery)
+
+    def on_management_message(self, event):
+        request = _proton.Message()
+        request.decode(event.message.data)
+
+        self.accept(event.delivery)
+
+        properties = request.properties or dict()
+        operation = properties.get("operation")
+
+        if operation not in _MANAGEMENT_OPERATIONS:
+            self.respond(request, 400, "Unknown operation '{0}'".format(operation))
+            return
+
+        self.broker.info("Received management request '{0}' from {1}",
+                         operation, _container_repr(event.connection))
+
+        try:
+            getattr(self, "on_management_{0}".format(operation))(request, properties)
+        except (KeyError, TypeError, ValueError) as e:
+            self.respond(request, 400, "Bad request: {0}".format(e))
+
+    def get_managed_queue(self, request, properties, name="queue"):
+        address = properties[name]
+
+        try:
+            return self.queues[address]
+        except KeyError:
+            self.respond(request, 404, "Queue '{0}' not found".format(address))
+
+    def on_management_list(self, request, properties):
+        body = [self.queues[x].get_stats() for x in sorted(self.queues)]
+        self.respond(request, 200, "OK", body)
+
+    def on_management_stats(self, request, properties):
+        if "queue" in properties:
+            queue = self.get_managed_queue(request, properties)
+
+            if queue is not None:
+                self.respond(request, 200, "OK", queue.get_stats())
+
+            return
+
+        body = {
+            "queues": len(self.queues),
+            "depth": sum([len(x.messages) for x in self.queues.values()]),
+            "bytes": self.broker.queued_bytes,
+            "scheduled": len(self.broker.scheduler),
+            "producers": len(self.producers),
+            "transactions": len(self.transactions),
+        }
+
+        self.respond(request, 200, "OK", body)
+
+    def on_management_purge(self, request, properties):
+        queue = self.get_managed_queue(request, properties)
+
+        if queue is not None:
+            self.purge(request, queue)
+
+    def purge(self, request, queue):
+        def acknowledge(messages):
+            for message in messages:
+                queue.acknowledge(message)
+
+        def done(count):
+            self.broker.notice("Purged {0} messages from {1}", count, queue)
+            self.respond(request, 200, "OK", {"purged": count})
+
+        # Messages stored during the purge are kept
+        _BulkTask(self.broker.container, queue, len(queue.messages), acknowledge, done).start()
+
+    def on_management_move(self, request, properties):
+        queue = self.get_managed_queue(request, properties)
+
+        if queue is None:
+            return
+
+        target = self.get_queue(properties["target"])
+        count = int(properties.get("count", len(queue.messages)))
+
+        if target is queue:
+            raise ValueError("The target is the source queue")
+
+        def move(messages):
+            for message in messages:
+                queue.acknowledge(message)
+                target.enqueue(message)
+
+            target.forward_messages()
+
+        def done(count):
+            self.broker.notice("Moved {0} messages from {1} to {2}", count, queue, target)
+            self.respond(request, 200, "OK", {"moved": count})
+
+        _BulkTask(self.broker.container, queue, count, move, done).start()
+
+    def on_management_delete(self, request, properties):
+        queue = self.get_managed_queue(request, properties)
+
+        if queue is None:
+            return
+
+        del self.queues[queue.address]
+
+        if _is_wildcard(queue.address):
+            self.subscriptions.remove(queue.address, queue)
+
+        for link in list(queue.consumers) + list(queue.browsers):
+            link.condition = _proton.Condition("amqp:resource-deleted", "The queue was deleted")
+            link.close()
+
+        queue.consumers.clear()
+        queue.browsers.clear()
+
+        # Messages out for delivery are dropped, and their deliveries
+        # are settled here, so later outcomes are ignored
+        for messages in queue.unsettled.values():
+            for delivery, message in messages.items():
+                queue.acknowledge(message)
+                delivery.settle()
+
+        queue.unsettled.clear()
+
+        self.broker.scheduler.cancel(queue)
+
+        self.broker.notice("Deleted {0}", queue)
+
+        self.purge(request, queue)
+
+    def respond(self, request, status, description, body=None):
+        queue = self.queues.get(request.reply_to)
+
+        if queue is None:
+            self.broker.warn("Dropped the response to a management request with reply-to '{0}'",
+                             request.reply_to)
+            return
+
+        response = _proton.Message(body)
+        response.address = request.reply_to
+        response.correlation_id = request.id
+        response.properties = {"status-code": status, "status-description": description}
+
+        queue.enqueue(_Message(response.encode()))
+        queue.forward_messages()
+
+    def promote(self):
+        mirrors, self.mirrors = self.mirrors, None
+        count = 0
+
+        for address, mirror in mirrors.items():
+            queue = self.get_queue(address)
+
+            for data in mirror.values():
+                message = _Message(data)
+
+                # Messages not yet due are scheduled again
+                if not self.broker.scheduler.schedule(queue, message):
+                    queue.enqueue(message)
+
+                count += 1
+
+            queue.forward_messages()
+
+        batches, events, total_lag, max_lag = self.replication_stats
+
+        self.broker.notice("Promoted to primary with {0} replicated messages", count)
+
+        if batches:
+            self.broker.notice("Replicated {0} events in {1} batches, with a mean lag of {2:.1f} ms "
+                               "and a max lag of {3:.1f} ms",
+                               events, batches, total_lag / batches * 1000, max_lag * 1000)
+
     def on_link_closing(self, event):
-        if event.link.is_sender:
+        if event.link.is_receiver and self.remove_producer(event.link):
+            self.feed_starved()
+
+        if event.link.is_sender and event.link.source.address in self.queues:
             queue = self.queues[event.link.source.address]
             queue.remove_consumer(event.link)
 
+    def on_connection_bound(self, event):
+        if self.broker.capture is not None:
+            self.broker.capture.attach(event.connection, event.transport)
+
     def on_connection_opening(self, event):
         # XXX I think this should happen automatically
         event.connection.container = event.container.container_id
@@ -302,6 +2029,8 @@ class _Handler(_handlers.MessagingHandler):
 
     def on_connection_closing(self, event):
         self.remove_consumers(event.connection)
+        self.discard_transactions(event.connection)
+        self.check_primary(event.connection)
 
     def on_connection_closed(self, event):
         self.broker.notice("Closed connection from {0}", _container_repr(event.connection))
@@ -310,25 +2039,197 @@ class _Handler(_handlers.MessagingHandler):
         self.broker.notice("Disconnected from {0}", _container_repr(event.connection))
 
         self.remove_consumers(event.connection)
+        self.discard_transactions(event.connection)
+        self.check_primary(event.connection)
+
+    def check_primary(self, connection):
+        # The backup takes over when its primary goes away
+        if self.mirrors is not None and getattr(connection, "replication", False):
+            self.broker.warn("Lost the connection to the primary")
+            self.promote()
 
     def remove_consumers(self, connection):
         link = connection.link_head(_proton.Endpoint.REMOTE_ACTIVE)
 
         while link is not None:
-            if link.is_sender:
+            if link.is_sender and link.source.address in self.queues:
                 queue = self.queues[link.source.address]
                 queue.remove_consumer(link)
 
+            if link.is_receiver:
+                self.remove_producer(link)
+
             link = link.next(_proton.Endpoint.REMOTE_ACTIVE)
 
+    def discard_transactions(self, connection):
+        # Transactions not discharged by the client are rolled back
+
+        for transaction in list(self.transactions.values()):
+            if transaction.connection == connection:
+                del self.transactions[transaction.id]
+                transaction.rollback()
+
+    def get_transaction(self, delivery):
+        if delivery.remote_state != _TRANSACTIONAL_STATE:
+            return None
+
+        try:
+            return self.transactions[bytes(delivery.remote.data[0])]
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def on_link_opened(self, event):
+        if event.connection.state & _proton.Endpoint.LOCAL_CLOSED:
+            # Refused by a backup, so no credit is given
+            return
+
+        if event.link.is_receiver:
+            self.producers[event.link] = _Producer()
+            self.update_credit(event.link)
+
+    def remove_producer(self, link):
+        # Links left in the starved queue are skipped when it is fed
+        producer = self.producers.pop(link, None)
+
+        if producer is None:
+            return False
+
+        self.outstanding_credit -= producer.credit
+
+        return True
+
+    def update_credit(self, link):
+        # A producer's window doubles while its target queue is
+        # shallower than the window, and halves once the queue holds
+        # more than twice the window.  Credit is topped up when half
+        # the window is used, and the total outstanding credit across
+        # producers is bounded.
+
+        producer = self.producers.get(link)
+
+        if producer is None:
+            return
+
+        # Deliveries since the last update used some of the credit
+        self.outstanding_credit -= producer.credit - link.credit
+        producer.credit = link.credit
+
+        if link.credit > producer.window // 2:
+            return
+
+        queue = self.queues.get(link.target.address)
+        depth = 0 if queue is None else len(queue.messages)
+
+        if depth < producer.window:
+            producer.window = min(producer.window * 2, self.broker.max_link_credit)
+        elif depth > producer.window * 2:
+            producer.window = max(producer.window // 2, _MIN_CREDIT_WINDOW)
+
+        if link.target.address == _MANAGEMENT_ADDRESS:
+            # Administration requests aren't queued, so they are taken
+            # even while the broker is over its limits
+            available = producer.window
+        else:
+            available = self.get_available_credit()
+
+        credit = min(producer.window - link.credit, available)
+
+        if credit > 0:
+            link.flow(credit)
+
+            producer.credit += credit
+            self.outstanding_credit += credit
+
+        if producer.credit == 0 and not producer.starved:
+            producer.starved = True
+            self.starved.append(link)
+
+    def get_available_credit(self):
+        # No credit is granted while the queued messages are over the
+        # memory limit.  Credit already granted is not revoked, so the
+        # limit can be exceeded by the outstanding credit.
+
+        if self.broker.max_memory is not None and self.broker.queued_bytes >= self.broker.max_memory:
+            return 0
+
+        return self.broker.max_total_credit - self.outstanding_credit
+
+    def feed_starved(self):
+        while self.starved and self.get_available_credit() > 0:
+            link = self.starved.popleft()
+            producer = self.producers.get(link)
+
+            if producer is None:
+                continue
+
+            producer.starved = False
+            self.update_credit(link)
+
     def on_link_flow(self, event):
-        if event.link.is_sender and event.link.drain_mode:
-            event.link.drained()
+        link = event.link
+
+        if link.is_sender and link.drain_mode:
+            # Messages already queued are sent before the remaining
+            # credit is given back
+            queue = self.get_queue(link.source.address)
+            queue.forward_messages()
+
+            link.drained()
+
+            if self.starved:
+                self.feed_starved()
 
     def on_sendable(self, event):
         queue = self.get_queue(event.link.source.address)
         queue.forward_messages()
 
+        # Forwarding may bring the queued messages back under the
+        # memory limit
+        if self.starved:
+            self.feed_starved()
+
+    def on_delivery(self, event):
+        delivery = event.delivery
+
+        if delivery.link.is_receiver:
+            if delivery.aborted:
+                delivery.settle()
+            elif delivery.readable and not delivery.partial:
+                event.message = _Message(delivery.link.recv(delivery.pending))
+                delivery.link.advance()
+
+                if delivery.link.state & _proton.Endpoint.LOCAL_CLOSED \
+                        or delivery.connection.state & _proton.Endpoint.LOCAL_CLOSED:
+                    self.release(delivery, delivered=False)
+                else:
+                    self.on_message(event)
+
+                self.update_credit(delivery.link)
+
+                if self.starved:
+                    self.feed_starved()
+
+            return
+
+        # Transactional acknowledgments arrive as delivery updates on
+        # the broker's sending links
+
+        if not delivery.updated:
+            return
+
+        transaction = self.get_transaction(delivery)
+
+        if transaction is None:
+            return
+
+        try:
+            state = delivery.remote.data[1]
+        except IndexError:
+            state = None
+
+        delivery.queue.settle(delivery)
+        transaction.acknowledge(delivery, state)
+
     def on_settled(self, event):
         template = "Client '{0}' {1} {2} for {3}"
         client = event.connection.remote_container
@@ -344,17 +2245,146 @@ class _Handler(_handlers.MessagingHandler):
         elif delivery.remote_state == delivery.MODIFIED:
             self.broker.notice(template, client, "modified", _delivery_repr(delivery), source)
 
+        queue = delivery.queue
+        message = queue.settle(delivery)
+
+        if message is None:
+            return
+
+        if delivery.remote_state == delivery.RELEASED:
+            queue.requeue([message])
+        elif delivery.remote_state == delivery.MODIFIED:
+            if delivery.remote.failed:
+                message.delivery_count += 1
+
+            self.redeliver(queue, message)
+        elif delivery.remote_state == delivery.REJECTED and queue.max_delivery_count:
+            message.delivery_count += 1
+            self.redeliver(queue, message)
+        else:
+            queue.acknowledge(message)
+            return
+
+        queue.forward_messages()
+
+    def redeliver(self, queue, message):
+        if not queue.max_delivery_count or message.delivery_count < queue.max_delivery_count:
+            queue.requeue([message])
+            return
+
+        address = queue.dead_letter_address
+        queue.acknowledge(message)
+
+        if address in (None, "", queue.address):
+            self.broker.warn("Dropped {0} on {1} after {2} delivery attempts",
+                             message, queue, message.delivery_count)
+            return
+
+        message = message.annotate({
+            "x-opt-dead-letter-reason": "Exceeded the maximum delivery count of {0}".format(queue.max_delivery_count),
+            "x-opt-original-address": queue.address,
+        })
+
+        dead_letter_queue = self.get_queue(address)
+        dead_letter_queue.enqueue(message)
+        dead_letter_queue.forward_messages()
+
+        self.broker.notice("Moved {0} from {1} to {2}", message, queue, dead_letter_queue)
+
     def on_message(self, event):
         message = event.message
         delivery = event.delivery
+
+        if event.link.target.type == _proton.Terminus.COORDINATOR:
+            self.on_coordinator_message(event)
+            return
+
         address = event.link.target.address
 
+        if address == _REPLICATION_ADDRESS:
+            self.on_replication_message(event)
+            return
+
+        if address == _MANAGEMENT_ADDRESS:
+            self.on_management_message(event)
+            return
+
         if address in (None, ""):
             address = message.address
 
-        queue = self.get_queue(address)
-        queue.store_message(delivery, message)
-        queue.forward_messages()
+        if address in (None, ""):
+            # Sent on an anonymous link without a 'to' address, so
+            # there is nowhere to route it
+            self.broker.warn("Rejected {0} with no address", message)
+
+            delivery.local.condition = _proton.Condition("amqp:precondition-failed", "The message has no address")
+            self.reject(delivery)
+            return
+
+        queues = self.route(address)
+        transaction = self.get_transaction(delivery)
+
+        if transaction is not None:
+            # Held until the transaction is discharged
+            for queue, copy in zip(queues, _copies(message)):
+                transaction.enqueue(queue, copy)
+
+            delivery.local.data = [transaction.id, _proton.Described(_proton.ulong(delivery.ACCEPTED), [])]
+            delivery.update(_TRANSACTIONAL_STATE)
+            delivery.settle()
+
+            return
+
+        for queue, copy in zip(queues, _copies(message)):
+            queue.store_message(delivery, copy)
+            queue.forward_messages()
+
+        if self.broker.replicator is not None and self.broker.replicator.hold(delivery):
+            return
+
+        self.accept(delivery)
+
+    def on_coordinator_message(self, event):
+        message = _proton.Message()
+        message.decode(event.message.data)
+
+        body = message.body
+        delivery = event.delivery
+
+        if not isinstance(body, _proton.Described):
+            self.reject(delivery)
+            return
+
+        if body.descriptor in _DECLARE:
+            transaction = _Transaction(self.broker, event.connection)
+            self.transactions[transaction.id] = transaction
+
+            delivery.local.data = [transaction.id]
+            delivery.update(_DECLARED)
+            delivery.settle()
+
+            return
+
+        if body.descriptor in _DISCHARGE:
+            id, failed = (list(body.value) + [False])[:2]
+
+            try:
+                transaction = self.transactions.pop(bytes(id))
+            except (KeyError, TypeError):
+                delivery.local.condition = _proton.Condition("amqp:transaction:unknown-id")
+                self.reject(delivery)
+                return
+
+            if failed:
+                transaction.rollback()
+            else:
+                transaction.commit()
+
+            self.accept(delivery)
+
+            return
+
+        self.reject(delivery)
 
     def on_unhandled(self, name, event):
         self.broker.debug("Unhandled event: {0} {1}", name, event)
@@ -387,6 +2417,65 @@ def wait_for_broker(ready_file, timeout=30):
         else:
             print("Still waiting for the broker")
 
+def _parse_queue_options(value):
+    # ADDRESS:OPTION=VALUE[,OPTION=VALUE]
+
+    address, sep, options = value.rpartition(":")
+
+    if not sep or not address:
+        raise ValueError(value)
+
+    return address, dict(x.split("=", 1) for x in options.split(","))
+
+def _check_queue_options(address, options):
+    # Raises ValueError with a message for the first bad option
+
+    names = ("max-delivery-count", "dead-letter-address", "last-value-key", "duplicate-window",
+             "duplicate-filter")
+
+    for name, value in options.items():
+        if name not in names:
+            raise ValueError("Unknown option '{0}' for queue '{1}'".format(name, address))
+
+        if not value:
+            raise ValueError("Option '{0}' for queue '{1}' has no value".format(name, address))
+
+    for name, minimum in (("max-delivery-count", 0), ("duplicate-window", 1)):
+        if name not in options:
+            continue
+
+        try:
+            value = int(options[name])
+        except ValueError:
+            value = None
+
+        if value is None or value < minimum:
+            raise ValueError("Option '{0}' for queue '{1}' must be an integer of at least {2}"
+                             .format(name, address, minimum))
+
+    if options.get("duplicate-filter", "lru") not in ("lru", "bloom"):
+        raise ValueError("Option 'duplicate-filter' for queue '{0}' must be lru or bloom".format(address))
+
+    if "duplicate-filter" in options and "duplicate-window" not in options:
+        raise ValueError("Option 'duplicate-filter' for queue '{0}' requires duplicate-window".format(address))
+
+    if "dead-letter-address" in options:
+        if not int(options.get("max-delivery-count", 0)):
+            raise ValueError("Option 'dead-letter-address' for queue '{0}' requires max-delivery-count"
+                             .format(address))
+
+        if options["dead-letter-address"] == address:
+            raise ValueError("Queue '{0}' can't be its own dead-letter address".format(address))
+
+def _parse_size(value):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip().upper()
+
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+
+    return int(value)
+
 def main():
     import argparse
 
@@ -396,6 +2485,10 @@ def main():
                         help="Listen for connections on HOST (default localhost)")
     parser.add_argument("--port", metavar="PORT", default=5672, type=int,
                         help="Listen for connections on PORT (default 5672)")
+    parser.add_argument("--listen", metavar="URL", action="append", default=[],
+                        help="Listen for connections at URL, one of amqp://HOST:PORT, amqps://HOST:PORT, "
+                        "or unix:PATH.  This option can be repeated, and all listeners share the "
+                        "same queues.  If set, --host and --port are ignored.")
     parser.add_argument("--id", metavar="ID",
                         help="Set the container identity to ID (default is generated)")
     parser.add_argument("--ready-file", metavar="FILE",
@@ -414,6 +2507,38 @@ def main():
     parser.add_argument("--trust", metavar="FILE",
                         help="The file containing trusted client certificates.  "
                         "If set, the server verifies client certificates.")
+    parser.add_argument("--queue", metavar="ADDRESS:OPTION=VALUE[,OPTION=VALUE]", action="append",
+                        type=_parse_queue_options, default=[], dest="queue_options",
+                        help="Configure the queue at ADDRESS.  "
+                        "Options are max-delivery-count, dead-letter-address, last-value-key, "
+                        "duplicate-window, and duplicate-filter (lru or bloom).  "
+                        "This option can be repeated.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time the broker's event handlers and print a periodic summary")
+    parser.add_argument("--profile-interval", metavar="SECONDS", default=10, type=float,
+                        help="Print the profile summary every SECONDS (default 10)")
+    parser.add_argument("--profile-output", metavar="FILE",
+                        help="With --profile, also write FILE.  A FILE ending in .prof gets "
+                        "cProfile stats.  Otherwise FILE gets sampled stacks in collapsed format "
+                        "for flame graphs.")
+    parser.add_argument("--replicate-to", metavar="URL",
+                        help="Replicate queue contents to the backup broker at URL.  A producer's "
+                        "message is accepted once the backup has it.  While the backup is away, "
+                        "messages are accepted without waiting and replicated when it returns.")
+    parser.add_argument("--backup", action="store_true",
+                        help="Start as a backup.  The broker refuses clients and mirrors "
+                        "its primary until the primary goes away.")
+    parser.add_argument("--max-link-credit", metavar="COUNT", default=1000, type=int,
+                        help="The largest credit window granted to one producer link (default 1000)")
+    parser.add_argument("--max-total-credit", metavar="COUNT", default=10000, type=int,
+                        help="The most credit outstanding across all producer links (default 10000)")
+    parser.add_argument("--max-memory", metavar="BYTES", type=_parse_size,
+                        help="Stop granting credit to producers while queued messages use more than BYTES.  "
+                        "BYTES can have a K, M, or G suffix.")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="Record the inbound frames of each client connection to FILE, for replay "
+                        "with brokerreplay.  A FILE ending in .gz is compressed.  TLS connections "
+                        "are not recorded.")
     parser.add_argument("--quiet", action="store_true",
                         help="Print no logging to the console")
     parser.add_argument("--verbose", action="store_true",
@@ -425,6 +2550,12 @@ def main():
 
     args = parser.parse_args()
 
+    for address, options in args.queue_options:
+        try:
+            _check_queue_options(address, options)
+        except ValueError as e:
+            parser.error(str(e))
+
     class _Broker(Broker):
         def debug(self, message, *args):
             if self.debug_enabled:
@@ -449,9 +2580,18 @@ def main():
     broker = _Broker(args.host, args.port, id=args.id, ready_file=args.ready_file,
                      # user=args.user, password=args.password, allowed_mechs=args.allowed_mechs,
                      cert=args.cert, key=args.key, trust=args.trust,
+                     queue_options=dict(args.queue_options),
+                     profile=args.profile, profile_interval=args.profile_interval,
+                     profile_output=args.profile_output,
+                     replicate_to=args.replicate_to, backup=args.backup,
+                     max_link_credit=args.max_link_credit, max_total_credit=args.max_total_credit,
+                     max_memory=args.max_memory, listen=args.listen, capture=args.capture,
                      quiet=args.quiet, verbose=args.verbose, debug_enabled=args.debug,
                      init_only=args.init_only)
 
+    # Stop on SIGTERM as on an interrupt, so the broker cleans up
+    _signal.signal(_signal.SIGTERM, _signal.default_int_handler)
+
     try:
         broker.run()
     except KeyboardInterrupt:
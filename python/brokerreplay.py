@@ -0,0 +1,360 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+
+# Replays a capture recorded with brokerlib's --capture option against
+# a broker.  Each recorded connection gets its own socket, and its
+# frames are sent at the recorded times, at a multiple of the recorded
+# speed, or as fast as possible.
+#
+# A client's frames depend on what the broker sent it, so frames are
+# also held until the broker has caught up: until the SASL outcome,
+# until open, begin, and attach are answered, until a sender link has
+# credit for a transfer, and until the deliveries a disposition
+# settles have arrived.
+#
+# Usage: python -m brokerreplay [--speed FACTOR | --fast] CAPTURE-FILE [HOST:PORT]
+
+from __future__ import print_function
+
+import brokerlib as _brokerlib
+import proton as _proton
+import selectors as _selectors
+import socket as _socket
+import sys as _sys
+import time as _time
+
+# Performative and SASL frame body descriptor codes
+_OPEN = 0x10
+_BEGIN = 0x11
+_ATTACH = 0x12
+_FLOW = 0x13
+_TRANSFER = 0x14
+_DISPOSITION = 0x15
+_SASL_INIT = 0x41
+_SASL_OUTCOME = 0x44
+
+def _decode(frame):
+    # Returns the channel, descriptor code, and fields of a frame, or
+    # None for protocol headers and empty frames
+
+    if frame[:4] == b"AMQP":
+        return None
+
+    body = frame[frame[4] * 4:]
+
+    if not body:
+        return None
+
+    data = _proton.Data()
+    data.decode(body)
+    data.rewind()
+    data.next()
+
+    performative = data.get_object()
+
+    return int.from_bytes(frame[6:8], "big"), int(performative.descriptor), list(performative.value)
+
+class _ReplayConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.closed = False
+
+        # Replies the client is waiting on
+        self.expected = set()
+
+        self.link_names = dict() # (Client channel, handle) => name
+        self.broker_link_names = dict() # (Broker channel, handle) => name
+        self.broker_channels = dict() # Broker channel => client channel
+
+        self.delivery_counts = dict() # Link name => deliveries sent
+        self.credit_limits = dict() # Link name => delivery count the broker allows
+        self.partial = set() # Link names with a multi-frame delivery in progress
+        self.last_delivery_ids = dict() # Client channel => last delivery ID received
+
+    def receive(self, data):
+        self.buffer += data
+        buffer = self.buffer
+        offset = 0
+
+        while len(buffer) - offset >= 8:
+            if buffer[offset:offset + 4] == b"AMQP":
+                end = offset + 8
+            else:
+                end = offset + int.from_bytes(buffer[offset:offset + 4], "big")
+
+            if end > len(buffer) or end - offset < 8:
+                break
+
+            decoded = _decode(bytes(buffer[offset:end]))
+
+            if decoded is not None:
+                self.on_broker_frame(*decoded)
+
+            offset = end
+
+        del buffer[:offset]
+
+    def on_broker_frame(self, channel, code, fields):
+        if code == _SASL_OUTCOME:
+            self.expected.discard("sasl")
+        elif code == _OPEN:
+            self.expected.discard("open")
+        elif code == _BEGIN:
+            self.broker_channels[channel] = fields[0]
+            self.expected.discard(("begin", fields[0]))
+        elif code == _ATTACH:
+            self.broker_link_names[(channel, fields[1])] = fields[0]
+            self.expected.discard(("attach", fields[0]))
+        elif code == _FLOW and len(fields) > 6 and fields[4] is not None:
+            name = self.broker_link_names.get((channel, fields[4]))
+
+            if name in self.delivery_counts:
+                self.credit_limits[name] = fields[5] + fields[6]
+        elif code == _TRANSFER and fields[1] is not None:
+            client_channel = self.broker_channels.get(channel)
+            self.last_delivery_ids[client_channel] = fields[1]
+
+    def is_ready(self, decoded):
+        # Returns true if the broker has sent everything the frame
+        # depends on
+
+        if self.expected:
+            return False
+
+        if decoded is None:
+            return True
+
+        channel, code, fields = decoded
+
+        if code == _TRANSFER:
+            name = self.link_names.get((channel, fields[0]))
+
+            if name is None or name in self.partial:
+                return True
+
+            return self.credit_limits.get(name, 0) > self.delivery_counts[name]
+
+        if code == _DISPOSITION:
+            last = fields[2] if len(fields) > 2 and fields[2] is not None else fields[1]
+            received = self.last_delivery_ids.get(channel)
+
+            return received is not None and received >= last
+
+        return True
+
+    def on_client_frame(self, decoded):
+        if decoded is None:
+            return
+
+        channel, code, fields = decoded
+
+        if code == _SASL_INIT:
+            self.expected.add("sasl")
+        elif code == _OPEN:
+            self.expected.add("open")
+        elif code == _BEGIN:
+            self.expected.add(("begin", channel))
+        elif code == _ATTACH:
+            name = fields[0]
+
+            self.link_names[(channel, fields[1])] = name
+            self.expected.add(("attach", name))
+
+            if not fields[2]:
+                # A sender link, counting deliveries from its initial
+                # delivery count
+                self.delivery_counts[name] = fields[9] if len(fields) > 9 and fields[9] is not None else 0
+        elif code == _TRANSFER:
+            name = self.link_names.get((channel, fields[0]))
+
+            if name is None:
+                return
+
+            if name not in self.partial:
+                self.delivery_counts[name] += 1
+
+            if len(fields) > 5 and fields[5]:
+                self.partial.add(name)
+            else:
+                self.partial.discard(name)
+
+class _Replay:
+    def __init__(self, host, port, speed, timeout=5):
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.timeout = timeout
+
+        self.connections = dict()
+        self.selector = _selectors.DefaultSelector()
+
+        self.connection_count = 0
+        self.frames = 0
+        self.bytes = 0
+        self.stalls = 0
+        self.recorded_time = 0
+
+    def run(self, records):
+        start = _time.time()
+
+        for type, number, time, frame in records:
+            if self.speed:
+                self.wait(start + time / self.speed)
+            else:
+                self.drain(0)
+
+            if type == _brokerlib.CAPTURE_OPEN:
+                self.open(number)
+            elif type == _brokerlib.CAPTURE_FRAME:
+                self.send(number, frame)
+            elif type == _brokerlib.CAPTURE_CLOSE:
+                self.close(number)
+
+            self.recorded_time = time
+
+        duration = _time.time() - start
+
+        # Give the broker a moment to finish with what was sent.  This
+        # is not part of the replay time.
+        self.wait(_time.time() + 0.5)
+
+        for number in list(self.connections):
+            self.close(number)
+
+        return duration
+
+    def wait(self, deadline, ready=None):
+        # Reads from the broker until the deadline, or until ready
+        # returns true
+
+        while ready is None or not ready():
+            timeout = deadline - _time.time()
+
+            if timeout <= 0:
+                return False
+
+            self.drain(timeout)
+
+        return True
+
+    def drain(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            connection = key.data
+
+            try:
+                data = connection.sock.recv(65536)
+            except _socket.error:
+                data = b""
+
+            if data:
+                connection.receive(data)
+            else:
+                self.selector.unregister(connection.sock)
+                connection.closed = True
+
+    def open(self, number):
+        sock = _socket.create_connection((self.host, self.port))
+        sock.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+
+        connection = _ReplayConnection(sock)
+
+        self.connections[number] = connection
+        self.selector.register(sock, _selectors.EVENT_READ, connection)
+        self.connection_count += 1
+
+    def send(self, number, frame):
+        connection = self.connections.get(number)
+
+        if connection is None or connection.closed:
+            return
+
+        decoded = _decode(frame)
+
+        def ready():
+            return connection.closed or connection.is_ready(decoded)
+
+        if not ready() and not self.wait(_time.time() + self.timeout, ready=ready):
+            # Sent anyway, in case the broker behaves differently
+            # from the recording
+            self.stalls += 1
+
+        if connection.closed:
+            return
+
+        try:
+            connection.sock.sendall(frame)
+        except _socket.error:
+            connection.closed = True
+            return
+
+        connection.on_client_frame(decoded)
+
+        self.frames += 1
+        self.bytes += len(frame)
+
+    def close(self, number):
+        connection = self.connections.pop(number, None)
+
+        if connection is None:
+            return
+
+        if not connection.closed:
+            self.selector.unregister(connection.sock)
+
+        connection.sock.close()
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay a brokerlib capture file against a broker")
+    parser.add_argument("capture", metavar="CAPTURE-FILE",
+                        help="A file recorded with the broker's --capture option")
+    parser.add_argument("address", metavar="HOST:PORT", nargs="?", default="localhost:5672",
+                        help="The broker to replay against (default localhost:5672)")
+    parser.add_argument("--speed", metavar="FACTOR", type=float, default=1.0,
+                        help="Replay at FACTOR times the recorded speed (default 1)")
+    parser.add_argument("--fast", action="store_true",
+                        help="Replay as fast as possible, ignoring the recorded times")
+
+    args = parser.parse_args()
+
+    host, _, port = args.address.rpartition(":")
+    speed = None if args.fast else args.speed
+
+    if speed is not None and speed <= 0:
+        parser.error("The speed must be greater than zero")
+
+    replay = _Replay(host or "localhost", int(port), speed)
+    duration = replay.run(_brokerlib.read_capture(args.capture))
+
+    print("Connections:     {0:>12}".format(replay.connection_count))
+    print("Frames:          {0:>12}".format(replay.frames))
+    print("Bytes:           {0:>12}".format(replay.bytes))
+    print("Stalls:          {0:>12}".format(replay.stalls))
+    print("Recorded time:   {0:>12.3f} s".format(replay.recorded_time))
+    print("Replay time:     {0:>12.3f} s".format(duration))
+    print("Frame rate:      {0:>12.0f} frames/s".format(replay.frames / duration if duration else 0))
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
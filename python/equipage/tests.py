@@ -17,11 +17,17 @@
 # under the License.
 #
 
+import socket as _socket
 import sys as _sys
+import time as _time
 
 from brokerlib import wait_for_broker
 from commandant import TestSkipped
 from plano import *
+from proton import Message, ProtonException, Timeout
+from proton.handlers import TransactionHandler
+from proton.reactor import Copy
+from proton.utils import BlockingConnection, SendException
 
 def open_test_session(session):
     enable_logging(level="error")
@@ -265,6 +271,8 @@ def test_qpid_proton_python_send_receive(session):
         with TestServer() as server:
             call("{0} {1} q1 abc", python_prog("send.py"), server.connection_url)
             call("{0} {1} q1 1", python_prog("receive.py"), server.connection_url)
+            call("{0} --count 100 --size 10 --window 10 {1} q1", python_prog("send.py"), server.connection_url)
+            call("{0} --prefetch 50 --ack-batch 10 {1} q1 100", python_prog("receive.py"), server.connection_url)
 
 def test_qpid_proton_python_request_respond(session):
     with working_dir(join(session.examples_dir, "qpid-proton-python")):
@@ -275,6 +283,30 @@ def test_qpid_proton_python_request_respond(session):
             with start_process("{0} {1} q1 1", python_prog("respond.py"), server.connection_url):
                 call("{0} {1} q1 abc", python_prog("request.py"), server.connection_url)
 
+            with start_process("{0} --workers 4 {1} q1 100", python_prog("respond.py"), server.connection_url):
+                call("{0} --count 100 --concurrency 10 {1} q1 abc", python_prog("request.py"), server.connection_url)
+
+def test_qpid_proton_python_async(session):
+    with working_dir(join(session.examples_dir, "qpid-proton-python")):
+        check_send_usage(python_prog("async/send.py"))
+        check_receive_usage(python_prog("async/receive.py"))
+        check_request_usage(python_prog("async/request.py"))
+
+        with TestServer() as server:
+            call("{0} {1} q1 abc", python_prog("async/send.py"), server.connection_url)
+            call("{0} {1} q1 1", python_prog("async/receive.py"), server.connection_url)
+
+            with start_process("{0} {1} q1 1", python_prog("respond.py"), server.connection_url):
+                call("{0} {1} q1 abc", python_prog("async/request.py"), server.connection_url)
+
+def test_qpid_proton_python_pooled(session):
+    with working_dir(join(session.examples_dir, "qpid-proton-python")):
+        check_send_usage(python_prog("pooled/send.py"))
+
+        with TestServer() as server:
+            call("{0} {1} q1 abc 10", python_prog("pooled/send.py"), server.connection_url)
+            call("{0} {1} q1 10", python_prog("receive.py"), server.connection_url)
+
 def test_qpid_proton_python_servers(session):
     with working_dir(join(session.examples_dir, "qpid-proton-python")):
         check_receive_usage(python_prog("servers/receive.py"))
@@ -285,6 +317,13 @@ def test_qpid_proton_python_servers(session):
             sleep(1)
             call("{0} {1} q1 abc", python_prog("send.py"), connection_url)
 
+        connection_url = "amqp://localhost:{0}".format(random_port())
+
+        with start_process("{0} --sink --credit 10 {1} q1 100", python_prog("servers/receive.py"), connection_url) as proc:
+            sleep(1)
+            call("{0} --count 100 {1} q1", python_prog("send.py"), connection_url)
+            wait_for_process(proc)
+
 def test_qpid_proton_python_auto_create(session):
     with working_dir(join(session.examples_dir, "qpid-proton-python")):
         check_send_usage(python_prog("auto-create/queue-send.py"))
@@ -312,6 +351,14 @@ def test_qpid_proton_python_subscriptions(session):
             call("{0} {1} t1 abc", python_prog("send.py"), server.connection_url)
             call("{0} {1} t1 1", python_prog("subscriptions/durable-shared-subscribe.py"), server.connection_url)
 
+            checkpoint = join(make_temp_dir(), "checkpoint")
+
+            call("{0} --count 10 {1} t1", python_prog("send.py"), server.connection_url)
+            call("{0} --batch 4 --checkpoint {2} {1} t1 6", python_prog("subscriptions/durable-subscribe.py"),
+                 server.connection_url, checkpoint)
+            call("{0} --batch 4 --checkpoint {2} {1} t1 4", python_prog("subscriptions/durable-subscribe.py"),
+                 server.connection_url, checkpoint)
+
 def test_qpid_proton_python_tracing(session):
     try:
         import opentracing
@@ -327,6 +374,17 @@ def test_qpid_proton_python_tracing(session):
             call("{0} {1} q1 abc", python_prog("send.py"), server.connection_url)
             call("{0} {1} q1 1", python_prog("receive.py"), server.connection_url)
 
+def test_qpid_proton_python_local_tracing(session):
+    with working_dir(join(session.examples_dir, "qpid-proton-python/tracing")):
+        trace_file = join(make_temp_dir(), "spans.jsonl")
+
+        with TestServer() as server:
+            call("{0} --trace-file {2} {1} q1 abc", python_prog("send.py"), server.connection_url, trace_file)
+            call("{0} --trace-file {2} --rate-limit 10 {1} q1 1", python_prog("receive.py"),
+                 server.connection_url, trace_file)
+
+        assert len(read_lines(trace_file)) == 2, read_lines(trace_file)
+
 def test_qpid_proton_ruby_connect(session):
     with working_dir(join(session.examples_dir, "qpid-proton-ruby")):
         check_connect_usage("ruby connect.rb")
@@ -454,8 +512,406 @@ def test_vertx_proton_reactive_streams_send_receive(session):
             call("{0} {1} q1 abc", java_prog("examples.reactivestreams.Send"), server.connection_url)
             call("{0} {1} q1 1", java_prog("examples.reactivestreams.Receive"), server.connection_url)
 
+def test_qpid_proton_python_broker_anonymous_relay(session):
+    with TestServer() as server:
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            sender = conn.create_sender(None)
+            sender.send(Message(u"abc", address="q1"))
+
+            try:
+                sender.send(Message(u"xyz"))
+            except SendException:
+                pass
+            else:
+                raise Exception("A message with no address was accepted")
+
+            receiver = conn.create_receiver("q1")
+            assert receiver.receive(timeout=10).body == u"abc"
+            receiver.accept()
+        finally:
+            conn.close()
+
+def test_qpid_proton_python_broker_transactions(session):
+    with TestServer() as server:
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            sender = conn.create_sender("q1")
+
+            run_transaction(conn, sender, [u"a", u"b"], commit=True)
+            run_transaction(conn, sender, [u"c"], commit=False)
+
+            receiver = conn.create_receiver("q1")
+
+            assert receive_bodies(receiver, 2) == [u"a", u"b"]
+            check_no_message(receiver)
+        finally:
+            conn.close()
+
+def test_qpid_proton_python_broker_dead_letter(session):
+    with TestServer("--queue q1:max-delivery-count=2,dead-letter-address=dlq") as server:
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            sender = conn.create_sender("q1")
+            sender.send(Message(u"abc"))
+
+            receiver = conn.create_receiver("q1")
+
+            # A release without a failed attempt doesn't count
+            receiver.receive(timeout=10)
+            receiver.release(delivered=False)
+
+            receiver.receive(timeout=10)
+            receiver.reject()
+            receiver.receive(timeout=10)
+            receiver.reject()
+
+            check_no_message(receiver)
+
+            receiver = conn.create_receiver("dlq")
+            message = receiver.receive(timeout=10)
+            receiver.accept()
+
+            assert message.body == u"abc", message
+            assert message.annotations["x-opt-original-address"] == "q1", message.annotations
+        finally:
+            conn.close()
+
+def test_qpid_proton_python_broker_browse(session):
+    with TestServer() as server:
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            sender = conn.create_sender("q1")
+
+            for body in (u"a", u"b", u"c"):
+                sender.send(Message(body))
+
+            receiver = conn.create_receiver("q1")
+            assert receive_bodies(receiver, 1) == [u"a"]
+            receiver.close()
+
+            # The browser starts at the queue head after the consume
+            browser = conn.create_receiver("q1", options=Copy())
+            assert receive_bodies(browser, 2) == [u"b", u"c"]
+            check_no_message(browser)
+            browser.close()
+
+            # Browsing leaves the messages on the queue
+            receiver = conn.create_receiver("q1")
+            assert receive_bodies(receiver, 2) == [u"b", u"c"]
+        finally:
+            conn.close()
+
+def test_qpid_proton_python_broker_wildcards(session):
+    with TestServer() as server:
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            one_word = conn.create_receiver("news.*")
+            any_words = conn.create_receiver("news.#")
+            exact = conn.create_receiver("news.a")
+
+            sender = conn.create_sender(None)
+            sender.send(Message(u"a", address="news.a"))
+            sender.send(Message(u"b", address="news.a.b"))
+            sender.send(Message(u"c", address="sports.a"))
+
+            assert receive_bodies(one_word, 1) == [u"a"]
+            check_no_message(one_word)
+
+            assert receive_bodies(any_words, 2) == [u"a", u"b"]
+            check_no_message(any_words)
+
+            # An address with a queue of its own keeps a copy
+            assert receive_bodies(exact, 1) == [u"a"]
+
+            # An address only subscribers wanted gets no queue
+            receiver = conn.create_receiver("news.a.b")
+            check_no_message(receiver)
+
+            receiver = conn.create_receiver("sports.a")
+            assert receive_bodies(receiver, 1) == [u"c"]
+        finally:
+            conn.close()
+
+def test_qpid_proton_python_broker_replication(session):
+    with TestServer("--backup") as backup:
+        with TestServer("--replicate-to 127.0.0.1:{0}".format(backup.port)) as primary:
+            conn = BlockingConnection(primary.connection_url, timeout=10)
+
+            try:
+                sender = conn.create_sender("q1")
+
+                # Each send returns once the backup has the message
+                for i in range(10):
+                    sender.send(Message(i))
+
+                receiver = conn.create_receiver("q1")
+                assert receive_bodies(receiver, 2) == [0, 1]
+            finally:
+                conn.close()
+
+            # Acknowledgments reach the backup asynchronously
+            sleep(0.5)
+
+        # The backup takes over when the primary goes away
+        conn, receiver = open_receiver_when_ready(backup.connection_url, "q1")
+
+        try:
+            assert receive_bodies(receiver, 8) == list(range(2, 10))
+            check_no_message(receiver)
+        finally:
+            conn.close()
+
+def test_qpid_proton_python_broker_adaptive_credit(session):
+    with working_dir(join(session.examples_dir, "qpid-proton-python")):
+        # Two producers share less credit than both windows at their
+        # largest, and still get all their messages through
+        with TestServer("--max-link-credit 20 --max-total-credit 30") as server:
+            with start_process("{0} --count 500 --size 100 {1} q1", python_prog("send.py"),
+                               server.connection_url) as proc1:
+                with start_process("{0} --count 500 --size 100 {1} q2", python_prog("send.py"),
+                                   server.connection_url) as proc2:
+                    call("{0} {1} q1 500", python_prog("receive.py"), server.connection_url)
+                    call("{0} {1} q2 500", python_prog("receive.py"), server.connection_url)
+
+                    wait_for_process(proc1)
+                    wait_for_process(proc2)
+
+def test_qpid_proton_python_broker_drain(session):
+    with TestServer() as server:
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            sender = conn.create_sender("q1")
+
+            for body in (u"a", u"b", u"c"):
+                sender.send(Message(body))
+
+            # Queued messages are sent before the credit is given back
+            receiver = conn.create_receiver("q1", credit=0)
+            receiver.link.drain(10)
+            conn.wait(lambda: receiver.link.credit == 0 and receiver.fetcher.has_message == 3, timeout=10)
+
+            assert receive_bodies(receiver, 3) == [u"a", u"b", u"c"]
+
+            # Draining an empty queue gives back all the credit
+            receiver.link.drain(10)
+            conn.wait(lambda: receiver.link.credit == 0, timeout=10)
+
+            assert receiver.fetcher.has_message == 0, receiver.fetcher.has_message
+        finally:
+            conn.close()
+
+def test_qpid_proton_python_broker_scheduled_delivery(session):
+    with TestServer() as server:
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            sender = conn.create_sender("q1")
+            sender.send(Message(u"later", annotations={"x-opt-delivery-delay": 1000}))
+
+            # A delivery time in the past is due at once
+            sender.send(Message(u"now", annotations={"x-opt-delivery-time": 1000}))
+
+            receiver = conn.create_receiver("q1")
+            assert receive_bodies(receiver, 1) == [u"now"]
+            check_no_message(receiver)
+
+            assert receive_bodies(receiver, 1) == [u"later"]
+        finally:
+            conn.close()
+
+def test_qpid_proton_python_broker_scheduled_failover(session):
+    with TestServer("--backup") as backup:
+        with TestServer("--replicate-to 127.0.0.1:{0}".format(backup.port)) as primary:
+            conn = BlockingConnection(primary.connection_url, timeout=10)
+
+            try:
+                sender = conn.create_sender("q1")
+                sender.send(Message(u"later", annotations={"x-opt-delivery-delay": 2000}))
+                sender.send(Message(u"now"))
+            finally:
+                conn.close()
+
+        # The backup holds the scheduled message after it takes over
+        conn, receiver = open_receiver_when_ready(backup.connection_url, "q1")
+
+        try:
+            assert receive_bodies(receiver, 1) == [u"now"]
+            check_no_message(receiver)
+
+            assert receive_bodies(receiver, 1) == [u"later"]
+        finally:
+            conn.close()
+
+def test_qpid_proton_python_broker_last_value(session):
+    with TestServer("--queue q1:last-value-key=key") as server:
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            sender = conn.create_sender("q1")
+            sender.send(Message(u"a1", properties={"key": "a"}))
+            sender.send(Message(u"b1", properties={"key": "b"}))
+            sender.send(Message(u"a2", properties={"key": "a"}))
+            sender.send(Message(u"x"))
+
+            # The replacement keeps the position of the message it
+            # replaced, and messages without the key are kept
+            receiver = conn.create_receiver("q1")
+            assert receive_bodies(receiver, 3) == [u"a2", u"b1", u"x"]
+            check_no_message(receiver)
+        finally:
+            conn.close()
+
+def test_qpid_proton_python_broker_duplicate_detection(session):
+    args = "--queue q1:duplicate-window=10 --queue q2:duplicate-window=10,duplicate-filter=bloom"
+
+    with TestServer(args) as server:
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            for address in ("q1", "q2"):
+                sender = conn.create_sender(address)
+                sender.send(Message(u"a", id="m1"))
+                sender.send(Message(u"b", id="m2"))
+                sender.send(Message(u"c", id="m1"))
+
+                receiver = conn.create_receiver(address)
+                assert receive_bodies(receiver, 2) == [u"a", u"b"]
+                check_no_message(receiver)
+        finally:
+            conn.close()
+
+def test_qpid_proton_python_broker_memory_limit(session):
+    with working_dir(join(session.examples_dir, "qpid-proton-python")):
+        # Producers stall while the queue is over the memory limit,
+        # and resume as the receiver drains it
+        with TestServer("--max-memory 2K") as server:
+            with start_process("{0} --count 500 --size 100 {1} q1", python_prog("send.py"),
+                               server.connection_url) as proc:
+                sleep(1)
+
+                assert proc.poll() is None, proc.returncode
+
+                call("{0} {1} q1 500", python_prog("receive.py"), server.connection_url)
+                wait_for_process(proc)
+
+def test_qpid_proton_python_broker_management(session):
+    with TestServer() as server:
+        admin = "{0} -m brokeradmin --url {1}".format(_sys.executable, server.connection_url)
+
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            sender = conn.create_sender("q1")
+
+            for i in range(3):
+                sender.send(Message(i))
+        finally:
+            conn.close()
+
+        assert "q1" in call_for_stdout("{0} list", admin)
+        assert "depth:         3" in call_for_stdout("{0} stats q1", admin)
+
+        assert "moved:         3" in call_for_stdout("{0} move q1 q2", admin)
+        assert "depth:         3" in call_for_stdout("{0} stats q2", admin)
+
+        assert "purged:        3" in call_for_stdout("{0} purge q2", admin)
+        call("{0} delete q2", admin)
+
+        try:
+            call("{0} purge q2", admin)
+        except CalledProcessError:
+            pass
+        else:
+            raise Exception("Purging a deleted queue succeeded")
+
+def test_qpid_proton_python_broker_management_over_memory_limit(session):
+    with working_dir(join(session.examples_dir, "qpid-proton-python")):
+        with TestServer("--max-memory 2K") as server:
+            admin = "{0} -m brokeradmin --url {1}".format(_sys.executable, server.connection_url)
+
+            with start_process("{0} --count 500 --size 100 {1} q1", python_prog("send.py"),
+                               server.connection_url) as proc:
+                sleep(1)
+
+                # Administration works while producers are stalled
+                stats = call_for_stdout("{0} stats q1", admin)
+                depth = int(stats.split("depth:")[1].split()[0])
+
+                assert 0 < depth < 500, depth
+
+                # Purging frees memory, so the producer resumes
+                for i in range(100):
+                    if proc.poll() is not None:
+                        break
+
+                    call_for_stdout("{0} purge q1", admin)
+                else:
+                    raise Exception("The producer didn't finish")
+
+                wait_for_process(proc)
+
+def test_qpid_proton_python_broker_unix_listener(session):
+    path = join(make_temp_dir(), "broker.sock")
+
+    # A socket file left behind by a broker that didn't exit cleanly
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.close()
+
+    server = TestServer()
+    server.broker_args = "--listen amqp://127.0.0.1:{0} --listen unix:{1}".format(server.port, path)
+
+    with server:
+        sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+        sock.settimeout(10)
+
+        try:
+            sock.connect(path)
+            sock.sendall(b"AMQP\x00\x01\x00\x00")
+            assert sock.recv(4) == b"AMQP"
+        finally:
+            sock.close()
+
+        conn = BlockingConnection(server.connection_url, timeout=10)
+        conn.close()
+
+    assert not exists(path), path
+
+def test_qpid_proton_python_broker_capture_replay(session):
+    capture_file = join(make_temp_dir(), "capture.gz")
+
+    with TestServer("--capture {0}".format(capture_file)) as server:
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            sender = conn.create_sender("q1")
+
+            for body in (u"a", u"b", u"c"):
+                sender.send(Message(body))
+        finally:
+            conn.close()
+
+    with TestServer() as server:
+        call("{0} -m brokerreplay --fast {1} 127.0.0.1:{2}", _sys.executable, capture_file, server.port)
+
+        conn = BlockingConnection(server.connection_url, timeout=10)
+
+        try:
+            receiver = conn.create_receiver("q1")
+            assert receive_bodies(receiver, 3) == [u"a", u"b", u"c"]
+        finally:
+            conn.close()
+
 class TestServer(object):
-    def __init__(self):
+    def __init__(self, broker_args=""):
+        self.broker_args = broker_args
         self.port = random_port()
         self.connection_url = "amqp://127.0.0.1:{0}".format(self.port)
         self.output_file = make_temp_file()
@@ -467,8 +923,10 @@ class TestServer(object):
         self.output = open(self.output_file, "w")
 
         with temp_file() as ready_file:
-            self.proc = start_process("{0} -m brokerlib --host 127.0.0.1 --port {1} --ready-file {2}",
-                                      _sys.executable, self.port, ready_file, output=self.output)
+            self.proc = start_process("{0} -m brokerlib --host 127.0.0.1 --port {1} --ready-file {2} {3}",
+                                      _sys.executable, self.port, ready_file, self.broker_args,
+                                      output=self.output)
+            self.proc.port = self.port
             self.proc.connection_url = self.connection_url
 
             wait_for_broker(ready_file)
@@ -522,6 +980,72 @@ def check_receive_usage(command):
 check_request_usage = check_send_usage
 check_respond_usage = check_receive_usage
 
+def open_receiver_when_ready(connection_url, address, timeout=10):
+    # A backup refuses clients until it takes over, so the first
+    # attempts can fail
+
+    deadline = _time.time() + timeout
+
+    while True:
+        try:
+            conn = BlockingConnection(connection_url, timeout=10)
+            return conn, conn.create_receiver(address)
+        except ProtonException:
+            if _time.time() > deadline:
+                raise
+
+            sleep(0.1)
+
+class TransactionTracker(TransactionHandler):
+    def __init__(self):
+        super(TransactionTracker, self).__init__()
+
+        self.state = None
+
+    def on_transaction_declared(self, event):
+        self.state = "declared"
+
+    def on_transaction_committed(self, event):
+        self.state = "committed"
+
+    def on_transaction_aborted(self, event):
+        self.state = "aborted"
+
+def run_transaction(conn, sender, bodies, commit):
+    tracker = TransactionTracker()
+    transaction = conn.container.declare_transaction(conn.conn, handler=tracker)
+
+    conn.wait(lambda: tracker.state == "declared", timeout=10)
+
+    for body in bodies:
+        transaction.send(sender.link, Message(body))
+
+    if commit:
+        transaction.commit()
+    else:
+        transaction.abort()
+
+    conn.wait(lambda: tracker.state in ("committed", "aborted"), timeout=10)
+
+    assert tracker.state == ("committed" if commit else "aborted"), tracker.state
+
+def receive_bodies(receiver, count):
+    bodies = list()
+
+    for i in range(count):
+        bodies.append(receiver.receive(timeout=10).body)
+        receiver.accept()
+
+    return bodies
+
+def check_no_message(receiver, timeout=0.5):
+    try:
+        message = receiver.receive(timeout=timeout)
+    except Timeout:
+        return
+
+    raise Exception("Unexpected message {0}".format(message))
+
 def dotnet_prog(project_dir):
     return "dotnet run --project {0}".format(project_dir)
 
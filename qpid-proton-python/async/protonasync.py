@@ -0,0 +1,387 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+# An asyncio adapter for proton.  The container runs on its own
+# thread.  Calls from the event loop are queued and handed to the
+# container with one EventInjector trigger per batch, and results come
+# back with one loop.call_soon_threadsafe per batch.
+
+import asyncio
+import collections
+import os
+import sys
+import threading
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from proton import Message
+from proton.handlers import MessagingHandler
+from proton.reactor import ApplicationEvent, Container, EventInjector
+from protoncommands import CommandQueue
+
+class Client:
+    def __init__(self, conn_url):
+        self.conn_url = conn_url
+
+        self._loop = None
+        self._handler = _BridgeHandler(self)
+        self._container = Container(self._handler)
+        self._injector = EventInjector()
+        self._thread = threading.Thread(target=self._container.run, daemon=True)
+
+        self._connection = None
+        self._links = dict() # Link name => sender or receiver
+        self._futures = set() # Unresolved futures, failed on a connection error
+        self._error = None # Set once the connection has failed
+
+        self._commands = CommandQueue(lambda: self._injector.trigger(ApplicationEvent("bridge_commands")))
+        self._results = CommandQueue(lambda: self._loop.call_soon_threadsafe(self._results.run))
+
+        # Request-response state
+        self._requester = None
+        self._requests = dict() # Correlation ID => response future
+
+    async def connect(self):
+        self._loop = asyncio.get_running_loop()
+
+        future = self._create_future()
+        self._handler.connect_future = future
+        self._thread.start()
+
+        await future
+
+    async def close(self):
+        if self._error is None:
+            future = self._create_future()
+            self._submit(self._close, future)
+
+            await future
+
+        await self._loop.run_in_executor(None, self._thread.join)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open_sender(self, address):
+        sender = Sender(self, address)
+        future = self._create_future()
+        self._submit(sender._open, future)
+
+        await future
+        return sender
+
+    async def open_receiver(self, address, credit=100):
+        receiver = Receiver(self, address, credit)
+        future = self._create_future()
+        self._submit(receiver._open, future)
+
+        await future
+        return receiver
+
+    async def request(self, address, body, timeout=None):
+        if self._requester is None:
+            # Concurrent first requests share one open
+            self._requester = _Requester(self)
+            self._requester.ready = self._create_future()
+            self._submit(self._requester._open, self._requester.ready)
+
+        requester = self._requester
+
+        try:
+            await asyncio.shield(requester.ready)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if self._requester is requester:
+                self._requester = None
+
+            raise
+
+        request = Message(body)
+        request.id = uuid.uuid4()
+        request.address = address
+
+        future = self._create_future()
+        self._submit(self._requester._send, request, future)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if not future.done() or future.cancelled():
+                self._submit(self._requests.pop, request.id, None)
+
+    # Event loop thread
+
+    def _create_future(self):
+        future = self._loop.create_future()
+
+        if self._error is not None:
+            # Nothing is left to resolve it
+            future.set_exception(self._error)
+            return future
+
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+
+        return future
+
+    def _submit(self, function, *args):
+        # Queue a call for the container thread
+        self._commands.submit(function, *args)
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+
+        for future in list(self._futures):
+            if not future.done():
+                future.set_exception(error)
+
+        self._end_receivers()
+
+    def _end_receivers(self):
+        for link in list(self._links.values()):
+            if isinstance(link, Receiver):
+                link._queue.put_nowait(None)
+
+    # Container thread
+
+    def _post(self, function, *args):
+        # Queue a call for the event loop thread
+        self._results.submit(function, *args)
+
+    def _resolve(self, future, result=None):
+        if future is not None:
+            self._post(_set_result, future, result)
+
+    def _close(self, future):
+        self._handler.close_future = future
+
+        if self._connection is None:
+            self._injector.close()
+            self._resolve(future)
+        else:
+            self._connection.close()
+
+class Sender:
+    def __init__(self, client, address):
+        self.address = address
+
+        self._client = client
+        self._link = None
+        self._open_future = None
+        self._pending = collections.deque() # Messages waiting for credit
+        self._unsettled = dict() # Delivery tag => settlement future
+
+    async def send(self, message):
+        """Send a message and return its remote state once the
+        receiver has settled it"""
+
+        future = self._client._create_future()
+        self._client._submit(self._send, message, future)
+
+        return await future
+
+    def _open(self, future):
+        self._open_future = future
+        self._link = self._client._container.create_sender(self._client._connection, self.address)
+        self._client._links[self._link.name] = self
+
+    def _on_opened(self):
+        self._client._resolve(self._open_future)
+        self._open_future = None
+
+    def _send(self, message, future):
+        self._pending.append((message, future))
+        self._flush()
+
+    def _flush(self):
+        while self._pending and self._link.credit > 0:
+            message, future = self._pending.popleft()
+            delivery = self._link.send(message)
+
+            if future is not None:
+                self._unsettled[delivery.tag] = future
+
+    def _on_settled(self, delivery):
+        self._client._resolve(self._unsettled.pop(delivery.tag, None), delivery.remote_state)
+
+class Receiver:
+    def __init__(self, client, address, credit):
+        self.address = address
+
+        self._client = client
+        self._credit = credit
+        self._link = None
+        self._open_future = None
+
+        self._queue = asyncio.Queue()
+        self._consumed = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self._queue.get()
+
+        if message is None:
+            raise StopAsyncIteration()
+
+        # Replenish credit in batches as messages are consumed, so a
+        # slow consumer pushes back on the sender
+
+        self._consumed += 1
+
+        if self._consumed >= max(1, self._credit // 2):
+            self._client._submit(self._link.flow, self._consumed)
+            self._consumed = 0
+
+        return message
+
+    def _open(self, future):
+        self._open_future = future
+        self._link = self._client._container.create_receiver(self._client._connection, self.address)
+        self._client._links[self._link.name] = self
+
+    def _on_opened(self):
+        self._link.flow(self._credit)
+
+        self._client._resolve(self._open_future)
+        self._open_future = None
+
+    def _on_message(self, message):
+        self._client._post(self._queue.put_nowait, message)
+
+class _Requester:
+    # An anonymous sender for requests and a dynamic receiver for the
+    # responses
+
+    def __init__(self, client):
+        self._client = client
+        self._sender = Sender(client, None)
+        self._receiver = None
+        self._reply_to = None
+        self._open_future = None
+
+        # Resolved on the event loop thread when the links are open
+        self.ready = None
+
+    def _open(self, future):
+        self._open_future = future
+        self._sender._open(None)
+
+        conn = self._client._connection
+        self._receiver = self._client._container.create_receiver(conn, None, dynamic=True)
+        self._client._links[self._receiver.name] = self
+
+    def _on_opened(self):
+        self._reply_to = self._receiver.remote_source.address
+        self._receiver.flow(1000)
+
+        self._client._resolve(self._open_future)
+        self._open_future = None
+
+    def _send(self, request, future):
+        request.reply_to = self._reply_to
+
+        self._client._requests[request.id] = future
+        self._sender._send(request, None)
+
+    def _on_message(self, message):
+        self._receiver.flow(1)
+        self._client._resolve(self._client._requests.pop(message.correlation_id, None), message)
+
+class _BridgeHandler(MessagingHandler):
+    def __init__(self, client):
+        # Receiver credit is managed by hand
+        super(_BridgeHandler, self).__init__(prefetch=0)
+
+        self.client = client
+        self.connect_future = None
+        self.close_future = None
+
+    def on_start(self, event):
+        event.container.selectable(self.client._injector)
+        self.client._connection = event.container.connect(self.client.conn_url, reconnect=False)
+
+    def on_connection_opened(self, event):
+        self.client._resolve(self.connect_future)
+
+    def on_link_opened(self, event):
+        link = self.client._links.get(event.link.name)
+
+        if link is not None:
+            link._on_opened()
+
+    def on_sendable(self, event):
+        link = self.client._links.get(event.link.name)
+
+        if isinstance(link, Sender):
+            link._flush()
+
+    def on_settled(self, event):
+        link = self.client._links.get(event.link.name)
+
+        if isinstance(link, Sender):
+            link._on_settled(event.delivery)
+
+    def on_message(self, event):
+        self.client._links[event.link.name]._on_message(event.message)
+
+    def on_bridge_commands(self, event):
+        self.client._commands.run()
+
+    def on_connection_closed(self, event):
+        self.client._injector.close()
+
+        if self.close_future is not None:
+            self.client._post(self.client._end_receivers)
+            self.client._resolve(self.close_future)
+        else:
+            # Closed by the peer, so pending sends and requests fail
+            self.client._post(self.client._fail, ConnectionError("The connection was closed by the peer"))
+
+    def on_connection_error(self, event):
+        # Called before on_connection_closed, so its error is the one
+        # reported
+        condition = event.connection.remote_condition
+        error = ConnectionError(condition.description if condition else "Connection error")
+
+        if self.close_future is None:
+            self.client._post(self.client._fail, error)
+
+    def on_transport_error(self, event):
+        condition = event.transport.condition
+        error = ConnectionError(condition.description if condition else "Transport error")
+
+        self.client._injector.close()
+
+        if self.close_future is not None:
+            self.client._resolve(self.close_future)
+        else:
+            self.client._post(self.client._fail, error)
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
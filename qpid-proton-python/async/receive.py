@@ -0,0 +1,59 @@
+#!/usr/bin/python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import asyncio
+import sys
+
+from protonasync import Client
+
+async def receive(conn_url, address, desired):
+    received = 0
+
+    async with Client(conn_url) as client:
+        receiver = await client.open_receiver(address)
+
+        print("RECEIVE: Opened receiver for source address '{0}'".format(address))
+
+        async for message in receiver:
+            print("RECEIVE: Received message '{0}'".format(message.body))
+
+            received += 1
+
+            if received == desired:
+                break
+
+def main():
+    try:
+        conn_url, address = sys.argv[1:3]
+    except ValueError:
+        sys.exit("Usage: receive.py <connection-url> <address> [<message-count>]")
+
+    try:
+        desired = int(sys.argv[3])
+    except (IndexError, ValueError):
+        desired = 0
+
+    asyncio.run(receive(conn_url, address, desired))
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import asyncio
+import sys
+
+from protonasync import Client
+
+async def request(conn_url, address, message_body):
+    async with Client(conn_url) as client:
+        print("REQUEST: Sending request '{0}'".format(message_body))
+
+        response = await client.request(address, message_body, timeout=10)
+
+        print("REQUEST: Received response '{0}'".format(response.body))
+
+def main():
+    try:
+        conn_url, address, message_body = sys.argv[1:4]
+    except ValueError:
+        sys.exit("Usage: request.py <connection-url> <address> <message-body>")
+
+    asyncio.run(request(conn_url, address, message_body))
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,55 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+# Hands calls from other threads to the thread that owns a proton
+# container, or to an asyncio event loop.  Calls are queued under a
+# lock, and only the first call of each batch wakes the owning thread,
+# so a burst of calls costs one wakeup.
+
+import collections
+import threading
+
+class CommandQueue:
+    def __init__(self, wake):
+        # wake is called, on the submitting thread, when a call is
+        # queued and no batch is waiting.  It must arrange for run()
+        # to be called on the owning thread.
+
+        self._wake = wake
+        self._lock = threading.Lock()
+        self._calls = collections.deque()
+        self._pending = False
+
+    def submit(self, function, *args):
+        with self._lock:
+            self._calls.append((function, args))
+            wake = not self._pending
+            self._pending = True
+
+        if wake:
+            self._wake()
+
+    def run(self):
+        with self._lock:
+            calls = list(self._calls)
+            self._calls.clear()
+            self._pending = False
+
+        for function, args in calls:
+            function(*args)
@@ -0,0 +1,40 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+
+# Latency summaries for the example programs.  Percentiles use the
+# nearest rank, so each reported value is one that was measured.
+
+def percentile(values, fraction):
+    # values must be sorted
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def format_latencies(latencies, percentiles=(0.5, 0.99)):
+    # Latencies are in seconds.  The summary is in milliseconds.
+
+    values = sorted(latencies)
+    fields = ["avg {0:.3f} ms".format(sum(values) / len(values) * 1000)]
+
+    for fraction in percentiles:
+        name = "p{0:g}".format(fraction * 100).replace(".", "")
+        fields.append("{0} {1:.3f} ms".format(name, percentile(values, fraction) * 1000))
+
+    fields.append("max {0:.3f} ms".format(values[-1] * 1000))
+
+    return ", ".join(fields)
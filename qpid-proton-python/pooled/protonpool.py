@@ -0,0 +1,335 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+# A connection, session, and sender pool for proton.  The container
+# runs on its own thread, and send() blocks the calling thread until
+# the message is settled.  send() is safe to call from many threads.
+#
+# Each pool holds at most max_connections connections to one URL.
+# Every connection has one session and up to max_senders senders,
+# evicting the least recently used.  Senders and connections idle for
+# longer than idle_timeout are closed, and a connection that fails is
+# dropped and replaced on the next send.  Connections use AMQP
+# heartbeats, so a peer that goes silent fails the connection's sends
+# after about heartbeat seconds instead of leaving them blocked.
+
+import collections
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from proton.handlers import MessagingHandler
+from proton.reactor import ApplicationEvent, Container, EventInjector
+from protoncommands import CommandQueue
+
+class PoolError(Exception):
+    pass
+
+class ConnectionPool:
+    def __init__(self, conn_url, max_connections=4, max_senders=100, idle_timeout=60, heartbeat=10):
+        self.conn_url = conn_url
+        self.max_connections = max_connections
+        self.max_senders = max_senders
+        self.idle_timeout = idle_timeout
+        self.heartbeat = heartbeat
+
+        self._handler = _PoolHandler(self)
+        self._container = Container(self._handler)
+        self._injector = EventInjector()
+
+        self._lock = threading.Lock() # Guards _closed
+        self._commands = CommandQueue(lambda: self._injector.trigger(ApplicationEvent("pool_commands")))
+        self._closed = False
+
+        # Container thread state
+        self._connections = list()
+        self._connections_by_conn = dict() # Proton connection => pooled connection
+
+        self._thread = threading.Thread(target=self._container.run, daemon=True)
+        self._thread.start()
+
+    def send(self, address, message, timeout=None):
+        """Send a message and return its remote state once the
+        receiver has settled it"""
+
+        future = concurrent.futures.Future()
+
+        # Submitting under the lock puts every accepted send ahead of
+        # the close command, so none is left waiting after the
+        # container stops
+        with self._lock:
+            if self._closed:
+                raise PoolError("The pool is closed")
+
+            self._commands.submit(self._send, address, message, future)
+
+        return future.result(timeout)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+
+            self._closed = True
+            self._commands.submit(self._close)
+
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Container thread
+
+    def _send(self, address, message, future):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        connection = self._choose_connection(address)
+        sender = connection.get_sender(address)
+
+        sender.pending.append((message, future))
+        sender.flush()
+
+    def _choose_connection(self, address):
+        # Prefer a connection that already has a sender for the
+        # address, then a new connection while under the limit, then
+        # the connection with the least outstanding work
+
+        for connection in self._connections:
+            if address in connection.senders:
+                return connection
+
+        if len(self._connections) < self.max_connections:
+            conn = self._container.connect(self.conn_url, handler=self._handler, reconnect=False,
+                                           heartbeat=self.heartbeat)
+            connection = _PooledConnection(self, conn)
+
+            self._connections.append(connection)
+            self._connections_by_conn[conn] = connection
+
+            return connection
+
+        return min(self._connections, key=lambda c: (c.outstanding(), len(c.senders)))
+
+    def _remove_connection(self, connection, error):
+        if connection not in self._connections:
+            return
+
+        self._connections.remove(connection)
+        del self._connections_by_conn[connection.conn]
+
+        connection.fail(error)
+
+    def _check_idle(self):
+        deadline = time.time() - self.idle_timeout
+
+        for connection in list(self._connections):
+            for address, sender in list(connection.senders.items()):
+                if sender.last_used < deadline and sender.idle():
+                    connection.close_sender(address)
+
+            if not connection.senders and connection.last_used < deadline:
+                self._remove_connection(connection, PoolError("Connection closed while idle"))
+                connection.conn.close()
+
+    def _close(self):
+        for connection in list(self._connections):
+            self._remove_connection(connection, PoolError("Pool closed"))
+            connection.conn.close()
+
+        self._handler.stop()
+        self._injector.close()
+
+class _PooledConnection:
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+        self.session = conn.session()
+        self.session.open()
+
+        self.senders = collections.OrderedDict() # Address => pooled sender, least recently used first
+        self.senders_by_name = dict() # Link name => pooled sender
+        self.last_used = time.time()
+
+    def get_sender(self, address):
+        self.last_used = time.time()
+
+        try:
+            sender = self.senders[address]
+        except KeyError:
+            self.evict_senders()
+
+            link = self.session.sender(address)
+            link.target.address = address
+            link.open()
+
+            sender = _PooledSender(link)
+
+            self.senders[address] = sender
+            self.senders_by_name[link.name] = sender
+        else:
+            self.senders.move_to_end(address)
+
+        sender.last_used = self.last_used
+
+        return sender
+
+    def evict_senders(self):
+        # Make room for one more sender, skipping senders with work in
+        # progress
+
+        excess = len(self.senders) + 1 - self.pool.max_senders
+
+        for address, sender in list(self.senders.items()):
+            if excess <= 0:
+                break
+
+            if sender.idle():
+                self.close_sender(address)
+                excess -= 1
+
+    def close_sender(self, address):
+        sender = self.senders.pop(address)
+        del self.senders_by_name[sender.link.name]
+
+        sender.link.close()
+
+    def outstanding(self):
+        return sum(len(s.pending) + len(s.unsettled) for s in self.senders.values())
+
+    def fail(self, error):
+        for sender in self.senders.values():
+            sender.fail(error)
+
+        self.senders.clear()
+        self.senders_by_name.clear()
+
+class _PooledSender:
+    def __init__(self, link):
+        self.link = link
+        self.pending = collections.deque() # Messages waiting for credit
+        self.unsettled = dict() # Delivery tag => future
+        self.last_used = time.time()
+
+    def idle(self):
+        return not self.pending and not self.unsettled
+
+    def flush(self):
+        while self.pending and self.link.credit > 0:
+            message, future = self.pending.popleft()
+            delivery = self.link.send(message)
+            self.unsettled[delivery.tag] = future
+
+    def settle(self, delivery):
+        future = self.unsettled.pop(delivery.tag, None)
+
+        if future is not None:
+            future.set_result(delivery.remote_state)
+
+    def fail(self, error):
+        for _, future in self.pending:
+            future.set_exception(error)
+
+        for future in self.unsettled.values():
+            future.set_exception(error)
+
+        self.pending.clear()
+        self.unsettled.clear()
+
+class _PoolHandler(MessagingHandler):
+    def __init__(self, pool):
+        super(_PoolHandler, self).__init__()
+
+        self.pool = pool
+        self.timer = None
+
+    def on_start(self, event):
+        event.container.selectable(self.pool._injector)
+        self.timer = event.container.schedule(self.pool.idle_timeout / 2.0, self)
+
+    def on_pool_commands(self, event):
+        self.pool._commands.run()
+
+    def on_timer_task(self, event):
+        self.pool._check_idle()
+        self.timer = event.container.schedule(self.pool.idle_timeout / 2.0, self)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def get_sender(self, event):
+        connection = self.pool._connections_by_conn.get(event.connection)
+
+        if connection is not None:
+            return connection.senders_by_name.get(event.link.name)
+
+    def on_sendable(self, event):
+        sender = self.get_sender(event)
+
+        if sender is not None:
+            sender.flush()
+
+    def on_settled(self, event):
+        sender = self.get_sender(event)
+
+        if sender is not None:
+            sender.settle(event.delivery)
+
+    def on_link_error(self, event):
+        # The remote peer refused or closed the sender.  Its work
+        # fails, and the next send opens a new one.
+
+        connection = self.pool._connections_by_conn.get(event.connection)
+        sender = self.get_sender(event)
+
+        if sender is None:
+            return
+
+        condition = event.link.remote_condition
+
+        sender.fail(PoolError(condition.description if condition else "Sender closed"))
+
+        for address, s in list(connection.senders.items()):
+            if s is sender:
+                connection.close_sender(address)
+
+    def on_connection_error(self, event):
+        self.fail_connection(event, event.connection.remote_condition)
+
+    def on_transport_error(self, event):
+        self.fail_connection(event, event.transport.condition)
+
+    def on_connection_closed(self, event):
+        self.fail_connection(event, None)
+
+    def fail_connection(self, event, condition):
+        connection = self.pool._connections_by_conn.get(event.connection)
+
+        if connection is not None:
+            description = condition.description if condition else "Connection closed"
+            self.pool._remove_connection(connection, PoolError(description))
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+
+import sys
+import threading
+
+from proton import Message
+from protonpool import ConnectionPool
+
+def main():
+    try:
+        conn_url, address, message_body = sys.argv[1:4]
+    except ValueError:
+        sys.exit("Usage: send.py <connection-url> <address> <message-body> [<message-count>]")
+
+    try:
+        count = int(sys.argv[4])
+    except (IndexError, ValueError):
+        count = 1
+
+    # The pool is shared by several threads, each blocking until its
+    # message is settled
+
+    with ConnectionPool(conn_url) as pool:
+        def send(index):
+            for i in range(index, count, 4):
+                message = Message(message_body)
+                pool.send(address, message)
+
+                print("SEND: Sent message '{0}'".format(message.body))
+
+        threads = [threading.Thread(target=send, args=(i,)) for i in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
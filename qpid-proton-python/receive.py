@@ -20,14 +20,24 @@
 
 from __future__ import print_function
 
+import getopt
+import os
 import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "common"))
 
 from proton.handlers import MessagingHandler
-from proton.reactor import Container
+from proton.reactor import AtMostOnce, Container
+from protonstats import format_latencies
 
 class ReceiveHandler(MessagingHandler):
-    def __init__(self, conn_url, address, desired):
-        super(ReceiveHandler, self).__init__()
+    def __init__(self, conn_url, address, desired, prefetch=10, ack_batch=0, ack_interval=0,
+                 presettled=False, summary=False):
+        # Accept deliveries in batches if either ack option is set
+        manual_ack = bool(ack_batch or ack_interval)
+
+        super(ReceiveHandler, self).__init__(prefetch=prefetch, auto_accept=not manual_ack)
 
         self.conn_url = conn_url
         self.address = address
@@ -35,13 +45,30 @@ class ReceiveHandler(MessagingHandler):
         self.desired = desired
         self.received = 0
 
+        self.manual_ack = manual_ack
+        self.ack_batch = ack_batch
+        self.ack_interval = ack_interval
+        self.presettled = presettled
+        self.summary = summary
+
+        self.unacked = list()
+        self.timer = None
+
+        self.start_time = None
+        self.end_time = None
+        self.latencies = list()
+
     def on_start(self, event):
         conn = event.container.connect(self.conn_url)
 
         # To connect with a user and password:
         # conn = event.container.connect(self.conn_url, user="<user>", password="<password>")
 
-        event.container.create_receiver(conn, self.address)
+        # At-most-once delivery: the sender settles each message
+        # before sending it, so there is nothing to acknowledge
+        options = AtMostOnce() if self.presettled else None
+
+        event.container.create_receiver(conn, self.address, options=options)
 
     def on_link_opened(self, event):
         print("RECEIVE: Opened receiver for source address '{0}'".format
@@ -49,29 +76,108 @@ class ReceiveHandler(MessagingHandler):
 
     def on_message(self, event):
         message = event.message
+        now = time.time()
+
+        if self.start_time is None:
+            self.start_time = now
+
+        self.end_time = now
 
-        print("RECEIVE: Received message '{0}'".format(message.body))
+        if message.creation_time:
+            self.latencies.append(now - message.creation_time)
+
+        if not self.summary:
+            print("RECEIVE: Received message '{0}'".format(message.body))
 
         self.received += 1
 
+        if self.manual_ack and not event.delivery.settled:
+            self.unacked.append(event.delivery)
+
+            if self.ack_batch and len(self.unacked) >= self.ack_batch:
+                self.acknowledge()
+            elif self.timer is None:
+                self.timer = event.container.schedule(self.ack_interval / 1000.0, self)
+
         if self.received == self.desired:
+            self.acknowledge()
+
             event.receiver.close()
             event.connection.close()
 
+    def on_timer_task(self, event):
+        self.timer = None
+        self.acknowledge()
+
+    def acknowledge(self):
+        # Accepting the batch together lets the library send
+        # contiguous deliveries as a single ranged disposition
+
+        for delivery in self.unacked:
+            self.accept(delivery)
+
+        del self.unacked[:]
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def print_summary(self):
+        if self.start_time is None:
+            print("RECEIVE: Received 0 messages")
+            return
+
+        duration = self.end_time - self.start_time
+
+        print("RECEIVE: Received {0} messages in {1:.3f} s ({2:.0f} messages/s)".format
+              (self.received, duration, self.received / duration if duration else 0))
+
+        if self.latencies:
+            print("RECEIVE: Latency from creation time {0}".format(format_latencies(self.latencies)))
+
+usage = """Usage: receive.py [--prefetch <n>] [--ack-batch <n>] [--ack-interval <ms>] [--presettled] <connection-url> <address> [<message-count>]"""
+
 def main():
     try:
-        conn_url, address = sys.argv[1:3]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "",
+                                       ["prefetch=", "ack-batch=", "ack-interval=", "presettled"])
+        opts = dict((name, int(value) if value else True) for name, value in opts)
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+
+    try:
+        conn_url, address = args[0:2]
     except ValueError:
-        sys.exit("Usage: receive.py <connection-url> <address> [<message-count>]")
+        sys.exit(usage)
 
     try:
-        desired = int(sys.argv[3])
+        desired = int(args[2])
     except (IndexError, ValueError):
         desired = 0
 
-    handler = ReceiveHandler(conn_url, address, desired)
+    if opts.get("--prefetch", 1) < 1 or opts.get("--ack-batch", 0) < 0 or opts.get("--ack-interval", 0) < 0:
+        sys.exit(usage)
+
+    ack_batch = opts.get("--ack-batch", 0)
+    ack_interval = opts.get("--ack-interval", 0)
+
+    if ack_batch and not ack_interval:
+        # Don't hold a partial batch indefinitely
+        ack_interval = 100
+
+    # With any option set, print a summary instead of each message
+    summary = bool(opts)
+
+    handler = ReceiveHandler(conn_url, address, desired, prefetch=opts.get("--prefetch", 10),
+                             ack_batch=ack_batch, ack_interval=ack_interval,
+                             presettled="--presettled" in opts, summary=summary)
     container = Container(handler)
-    container.run()
+
+    try:
+        container.run()
+    finally:
+        if summary:
+            handler.print_summary()
 
 if __name__ == "__main__":
     try:
@@ -20,6 +20,8 @@
 
 from __future__ import print_function
 
+import getopt
+import random
 import sys
 import time
 
@@ -28,44 +30,125 @@ from proton.handlers import *
 from proton.reactor import *
 
 class Handler(MessagingHandler):
-    def __init__(self, servers):
+    def __init__(self, servers, race=1, base_delay=0.1, max_delay=10.0):
         super(Handler, self).__init__()
 
         self.servers = servers
-        self.current_server_index = 0
+        self.race = race
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        # A score between 0 and 1 for each server, weighted toward its
+        # most recent connection outcomes
+        self.health = dict((server, 1.0) for server in servers)
+        self.last_tried = dict((server, 0.0) for server in servers)
 
         self.conn = None
+        self.server = None
+        self.attempts = dict() # Connection => server
+
+        self.delay = 0
+        self.timer = None
+        self.disconnect_time = None
+
+    def candidates(self):
+        # Healthiest first, then least recently tried
+        servers = sorted(self.servers, key=lambda s: (-self.health[s], self.last_tried[s]))
+        return servers[:self.race]
+
+    def update_health(self, server, healthy):
+        self.health[server] = self.health[server] * 0.5 + (0.5 if healthy else 0)
+
+    def connect(self, container):
+        for server in self.candidates():
+            print("Connecting to {0}".format(server))
 
-    def current_server(self):
-        return self.servers[self.current_server_index]
+            self.last_tried[server] = time.time()
 
-    def connect(self, event):
-        print("Connecting to {0}".format(self.current_server()))
+            conn = container.connect(server, reconnect=False)
+            self.attempts[conn] = server
 
-        self.conn = event.container.connect(self.current_server())
+    def schedule_reconnect(self, container):
+        # Exponential backoff with decorrelated jitter, so clients
+        # don't retry in lockstep
+
+        self.delay = min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, self.delay * 3)))
+        self.timer = container.schedule(self.delay, self)
+
+        print("Reconnecting in {0:.3f} s".format(self.delay))
 
     def on_start(self, event):
-        self.connect(event)
+        self.disconnect_time = time.time()
+        self.connect(event.container)
+
+    def on_timer_task(self, event):
+        self.timer = None
+        self.connect(event.container)
 
     def on_connection_opened(self, event):
-        print("Connected to {0}".format(self.current_server()))
+        server = self.attempts.pop(event.connection, None)
+
+        if server is None:
+            return
+
+        self.update_health(server, True)
+
+        if self.conn is not None:
+            # Lost the race
+            event.connection.close()
+            return
+
+        self.conn = event.connection
+        self.server = server
+        self.delay = 0
+
+        # Abandon the other attempts.  Closed connections produce no
+        # disconnected events.
+        for conn in self.attempts:
+            conn.close()
+
+        self.attempts.clear()
+
+        print("Connected to {0} in {1:.3f} s".format(server, time.time() - self.disconnect_time))
 
     def on_disconnected(self, event):
-        print("Disconnected from {0}".format(self.current_server()))
+        if event.connection == self.conn:
+            print("Disconnected from {0}".format(self.server))
 
-        self.conn.close()
+            self.update_health(self.server, False)
+            self.conn.close()
+            self.conn = None
+            self.disconnect_time = time.time()
+        else:
+            server = self.attempts.pop(event.connection, None)
 
-        self.current_server_index += 1
+            if server is None:
+                return
 
-        if self.current_server_index == len(self.servers):
-            self.current_server_index = 0
+            print("Failed to connect to {0}".format(server))
 
-        self.connect(event)
+            self.update_health(server, False)
+            event.connection.close()
+
+        if self.conn is None and not self.attempts and self.timer is None:
+            self.schedule_reconnect(event.container)
+
+usage = """Usage: custom-failover.py [--race <n>] [--base-delay <seconds>] [--max-delay <seconds>] <server> [<server> ...]"""
 
 def main():
-    servers = sys.argv[1:]
+    try:
+        opts, servers = getopt.gnu_getopt(sys.argv[1:], "", ["race=", "base-delay=", "max-delay="])
+        opts = dict((name, float(value)) for name, value in opts)
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+
+    race = int(opts.get("--race", 1))
+
+    if not servers or race < 1:
+        sys.exit(usage)
 
-    handler = Handler(servers)
+    handler = Handler(servers, race=race, base_delay=opts.get("--base-delay", 0.1),
+                      max_delay=opts.get("--max-delay", 10.0))
     container = Container(handler)
 
     container.run()
@@ -21,12 +21,18 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import getopt
+import os
 import sys
+import time
 import uuid
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "common"))
+
 from proton import Message
 from proton.handlers import MessagingHandler
 from proton.reactor import Container
+from protonstats import format_latencies
 
 class RequestHandler(MessagingHandler):
     def __init__(self, conn_url, address, message_body):
@@ -70,13 +76,160 @@ class RequestHandler(MessagingHandler):
         event.receiver.close()
         event.connection.close()
 
+class LoadRequestHandler(MessagingHandler):
+    def __init__(self, conn_url, address, message_body, count, concurrency, timeout):
+        super(LoadRequestHandler, self).__init__()
+
+        self.conn_url = conn_url
+        self.address = address
+        self.message_body = message_body
+
+        self.count = count
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        self.sender = None
+        self.reply_to = None
+        self.timer = None
+
+        self.sent = 0
+        self.completed = 0
+        self.timed_out = 0
+        self.late = 0
+
+        # Correlation ID => send time, in the order the requests
+        # were sent
+        self.in_flight = dict()
+        self.latencies = list()
+
+        self.start_time = None
+
+    def on_start(self, event):
+        conn = event.container.connect(self.conn_url)
+
+        self.sender = event.container.create_sender(conn, self.address)
+        event.container.create_receiver(conn, None, dynamic=True)
+
+    def on_link_opened(self, event):
+        if event.link.is_sender:
+            print("REQUEST: Opened sender for target address '{0}'".format
+                  (event.sender.target.address))
+
+        if event.link.is_receiver:
+            print("REQUEST: Opened dynamic receiver for responses")
+
+            self.reply_to = event.receiver.remote_source.address
+            self.start_time = time.time()
+            self.timer = event.container.schedule(self.timeout / 4.0, self)
+
+            self.send_requests()
+
+    def on_sendable(self, event):
+        self.send_requests()
+
+    def send_requests(self):
+        if self.reply_to is None:
+            return
+
+        while self.sender.credit > 0 and self.sent < self.count:
+            if len(self.in_flight) >= self.concurrency:
+                break
+
+            request = Message(self.message_body)
+            request.id = uuid.uuid4()
+            request.reply_to = self.reply_to
+
+            self.in_flight[request.id] = time.time()
+            self.sender.send(request)
+            self.sent += 1
+
+    def on_message(self, event):
+        send_time = self.in_flight.pop(event.message.correlation_id, None)
+
+        if send_time is None:
+            # A response to a request that already timed out
+            self.late += 1
+            return
+
+        self.latencies.append(time.time() - send_time)
+        self.completed += 1
+
+        self.check_done(event.connection)
+        self.send_requests()
+
+    def on_timer_task(self, event):
+        # Expire requests that have waited longer than the timeout.
+        # The oldest requests are first, so stop at the first one
+        # still inside it.
+
+        deadline = time.time() - self.timeout
+
+        for correlation_id, send_time in list(self.in_flight.items()):
+            if send_time > deadline:
+                break
+
+            del self.in_flight[correlation_id]
+            self.timed_out += 1
+
+        self.timer = event.container.schedule(self.timeout / 4.0, self)
+
+        self.check_done(self.sender.connection)
+        self.send_requests()
+
+    def check_done(self, connection):
+        if self.completed + self.timed_out < self.count:
+            return
+
+        self.timer.cancel()
+        self.report()
+
+        connection.close()
+
+    def report(self):
+        duration = time.time() - self.start_time
+
+        print("REQUEST: Completed {0} of {1} requests in {2:.3f} s ({3:.0f} requests/s)".format
+              (self.completed, self.count, duration, self.completed / duration))
+
+        if self.timed_out:
+            print("REQUEST: {0} requests timed out, {1} responses arrived late".format
+                  (self.timed_out, self.late))
+
+        if self.latencies:
+            print("REQUEST: Round-trip latency {0}".format(format_latencies(self.latencies, (0.5, 0.99, 0.999))))
+
+usage = """Usage: request.py <connection-url> <address> <message-body>
+       request.py --count <n> [--concurrency <n>] [--timeout <seconds>] <connection-url> <address> <message-body>"""
+
 def main():
     try:
-        conn_url, address, message_body = sys.argv[1:4]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["count=", "concurrency=", "timeout="])
+        opts = dict((name, float(value) if name == "--timeout" else int(value)) for name, value in opts)
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+
+    try:
+        conn_url, address, message_body = args[0:3]
     except ValueError:
-        sys.exit("Usage: request.py <connection-url> <address> <message-body>")
+        sys.exit(usage)
+
+    try:
+        message_body = unicode(message_body)
+    except NameError:
+        pass
+
+    if "--count" in opts:
+        count = opts["--count"]
+        concurrency = opts.get("--concurrency", 10)
+        timeout = opts.get("--timeout", 10.0)
+
+        if count < 1 or concurrency < 1 or timeout <= 0:
+            sys.exit(usage)
+
+        handler = LoadRequestHandler(conn_url, address, message_body, count, concurrency, timeout)
+    else:
+        handler = RequestHandler(conn_url, address, message_body)
 
-    handler = RequestHandler(conn_url, address, message_body)
     container = Container(handler)
     container.run()
 
@@ -21,11 +21,16 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
+import concurrent.futures
+import functools
+import getopt
 import sys
+import time
 
 from proton import Message
 from proton.handlers import MessagingHandler
-from proton.reactor import Container
+from proton.reactor import ApplicationEvent, Container, EventInjector
 
 class RespondHandler(MessagingHandler):
     def __init__(self, conn_url, address, desired):
@@ -72,18 +77,159 @@ class RespondHandler(MessagingHandler):
             event.receiver.close()
             event.connection.close()
 
+def process_request(body, delay=0):
+    # The request processing, run in a worker thread or process
+
+    if delay:
+        time.sleep(delay / 1000.0)
+
+    return body.upper()
+
+class PoolRespondHandler(MessagingHandler):
+    def __init__(self, conn_url, address, desired, workers, processes=False, delay=0):
+        # Credit is granted by hand, one unit per free worker
+        super(PoolRespondHandler, self).__init__(prefetch=0, auto_accept=False)
+
+        self.conn_url = conn_url
+        self.address = address
+
+        self.desired = desired
+        self.received = 0
+        self.responded = 0
+
+        self.workers = workers
+        self.process = functools.partial(process_request, delay=delay)
+
+        if processes:
+            self.pool = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+        # Completed work is handed back to the reactor thread through
+        # the injector.  Deque appends and pops are thread safe.
+        self.injector = EventInjector()
+        self.completed = collections.deque()
+        self.ready = collections.deque()
+
+        self.receiver = None
+        self.sender = None
+
+    def on_start(self, event):
+        event.container.selectable(self.injector)
+
+        conn = event.container.connect(self.conn_url)
+
+        self.receiver = event.container.create_receiver(conn, self.address)
+        self.sender = event.container.create_sender(conn, None)
+
+    def on_link_opened(self, event):
+        if event.link.is_sender:
+            print("RESPOND: Opened anonymous sender for responses")
+
+        if event.link.is_receiver:
+            print("RESPOND: Opened receiver for source address '{0}'".format
+                  (event.receiver.source.address))
+
+            self.grant_credit(self.workers)
+
+    def on_message(self, event):
+        request = event.message
+        delivery = event.delivery
+
+        self.received += 1
+
+        future = self.pool.submit(self.process, request.body)
+
+        def done(future):
+            self.completed.append((request, delivery, future))
+            self.injector.trigger(ApplicationEvent("response_ready"))
+
+        future.add_done_callback(done)
+
+    def on_response_ready(self, event):
+        while self.completed:
+            self.ready.append(self.completed.popleft())
+
+        self.send_responses()
+
+    def on_sendable(self, event):
+        if event.link == self.sender:
+            self.send_responses()
+
+    def send_responses(self):
+        while self.ready and self.sender.credit > 0:
+            request, delivery, future = self.ready.popleft()
+
+            try:
+                response = Message(future.result())
+            except Exception as e:
+                print("RESPOND: Request failed: {0}".format(e))
+                self.reject(delivery)
+            else:
+                response.address = request.reply_to
+                response.correlation_id = request.id
+
+                self.sender.send(response)
+
+                # Acknowledge the request only once its response is
+                # sent
+                self.accept(delivery)
+
+            self.responded += 1
+
+            if self.responded == self.desired:
+                self.stop()
+                return
+
+            # The worker is free for another request
+            self.grant_credit(1)
+
+    def grant_credit(self, credit):
+        # Don't take more requests than desired
+
+        if self.desired:
+            credit = min(credit, self.desired - self.received - self.receiver.credit)
+
+        if credit > 0:
+            self.receiver.flow(credit)
+
+    def stop(self):
+        self.receiver.connection.close()
+        self.injector.close()
+        self.pool.shutdown(wait=False)
+
+    def on_connection_closed(self, event):
+        self.injector.close()
+        self.pool.shutdown(wait=False)
+
+usage = """Usage: respond.py [--workers <n> [--processes] [--delay <ms>]] <connection-url> <address> [<message-count>]"""
+
 def main():
     try:
-        conn_url, address = sys.argv[1:3]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["workers=", "processes", "delay="])
+        opts = dict((name, int(value) if value else True) for name, value in opts)
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+
+    try:
+        conn_url, address = args[0:2]
     except ValueError:
-        sys.exit("Usage: respond.py <connection-url> <address> [<message-count>]")
+        sys.exit(usage)
 
     try:
-        desired = int(sys.argv[3])
+        desired = int(args[2])
     except (IndexError, ValueError):
         desired = 0
 
-    handler = RespondHandler(conn_url, address, desired)
+    if "--workers" in opts:
+        if opts["--workers"] < 1:
+            sys.exit(usage)
+
+        handler = PoolRespondHandler(conn_url, address, desired, opts["--workers"],
+                                     processes="--processes" in opts, delay=opts.get("--delay", 0))
+    else:
+        handler = RespondHandler(conn_url, address, desired)
+
     container = Container(handler)
     container.run()
 
@@ -20,11 +20,18 @@
 
 from __future__ import print_function
 
+import getopt
+import os
 import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "common"))
 
 from proton import Message
 from proton.handlers import MessagingHandler
 from proton.reactor import Container
+from protonstats import format_latencies
 
 class SendHandler(MessagingHandler):
     def __init__(self, conn_url, address, message_body):
@@ -59,11 +66,135 @@ class SendHandler(MessagingHandler):
         event.sender.close()
         event.connection.close()
 
+class BulkSendHandler(MessagingHandler):
+    def __init__(self, conn_url, address, count, size, rate, window):
+        super(BulkSendHandler, self).__init__()
+
+        self.conn_url = conn_url
+        self.address = address
+
+        self.count = count
+        self.rate = rate
+        self.window = window
+        self.message_body = u"x" * size
+
+        # Message IDs are unique across runs, so receivers can use
+        # them to recognize redelivered messages
+        self.id_prefix = str(uuid.uuid4())
+
+        self.sender = None
+        self.timer = None
+
+        self.sent = 0
+        self.settled = 0
+        self.rejected = 0
+
+        self.start_time = None
+        self.send_times = dict() # Delivery tag => send time
+        self.latencies = list()
+
+    def on_start(self, event):
+        conn = event.container.connect(self.conn_url)
+        self.sender = event.container.create_sender(conn, self.address)
+
+    def on_link_opened(self, event):
+        print("SEND: Opened sender for target address '{0}'".format
+              (event.sender.target.address))
+
+    def on_sendable(self, event):
+        self.send_messages(event.container)
+
+    def on_timer_task(self, event):
+        self.timer = None
+        self.send_messages(event.container)
+
+    def send_messages(self, container):
+        # Send while the receiver has granted credit and the number of
+        # unsettled deliveries is inside the window
+
+        if self.start_time is None:
+            self.start_time = time.time()
+
+        while self.sender.credit > 0 and self.sent < self.count:
+            if self.sent - self.settled >= self.window:
+                break
+
+            now = time.time()
+
+            if self.rate:
+                delay = self.start_time + float(self.sent) / self.rate - now
+
+                if delay > 0:
+                    if self.timer is None:
+                        self.timer = container.schedule(delay, self)
+
+                    break
+
+            message_id = "{0}-{1}".format(self.id_prefix, self.sent + 1)
+            delivery = self.sender.send(Message(self.message_body, id=message_id, creation_time=now))
+
+            self.send_times[delivery.tag] = now
+            self.sent += 1
+
+    def on_rejected(self, event):
+        self.rejected += 1
+
+    def on_settled(self, event):
+        send_time = self.send_times.pop(event.delivery.tag, None)
+
+        if send_time is not None:
+            self.latencies.append(time.time() - send_time)
+
+        self.settled += 1
+
+        if self.settled == self.count:
+            self.report()
+
+            event.sender.close()
+            event.connection.close()
+        else:
+            self.send_messages(event.container)
+
+    def report(self):
+        duration = time.time() - self.start_time
+
+        print("SEND: Sent {0} messages in {1:.3f} s ({2:.0f} messages/s)".format
+              (self.sent, duration, self.sent / duration))
+        print("SEND: Settle latency {0}".format(format_latencies(self.latencies)))
+
+        if self.rejected:
+            print("SEND: {0} messages were rejected".format(self.rejected))
+
+usage = """Usage: send.py <connection-url> <address> <message-body>
+       send.py --count <n> [--size <bytes>] [--rate <messages-per-second>] [--window <n>] <connection-url> <address>"""
+
 def main():
     try:
-        conn_url, address, message_body = sys.argv[1:4]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["count=", "size=", "rate=", "window="])
+        opts = dict((name, int(value)) for name, value in opts)
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+
+    if "--count" in opts:
+        try:
+            conn_url, address = args
+        except ValueError:
+            sys.exit(usage)
+
+        if opts["--count"] < 1 or opts.get("--window", 1) < 1:
+            sys.exit(usage)
+
+        handler = BulkSendHandler(conn_url, address, opts["--count"], opts.get("--size", 100),
+                                  opts.get("--rate", 0), opts.get("--window", 1000))
+        container = Container(handler)
+        container.run()
+
+        return
+
+    try:
+        conn_url, address, message_body = args[0:3]
     except ValueError:
-        sys.exit("Usage: send.py <connection-url> <address> <message-body>")
+        sys.exit(usage)
 
     handler = SendHandler(conn_url, address, message_body)
     container = Container(handler)
@@ -20,8 +20,13 @@
 
 from __future__ import print_function
 
+import getopt
+import multiprocessing
+import signal
 import sys
+import time
 
+from proton import Url
 from proton.handlers import MessagingHandler
 from proton.reactor import Container, ReceiverOption
 
@@ -59,17 +64,201 @@ class ReceiveHandler(MessagingHandler):
             self.acceptor.close()
             event.connection.close()
 
+class SinkHandler(MessagingHandler):
+    def __init__(self, listen_url, desired, window, acceptor_class, stats=None):
+        # Credit is managed per connection
+        super(SinkHandler, self).__init__(prefetch=0)
+
+        self.listen_url = Url(listen_url)
+        self.acceptor_class = acceptor_class
+
+        self.desired = desired
+        self.window = window
+
+        # Shared counters for a fan-out worker, or None to print
+        # statistics directly
+        self.stats = stats
+
+        self.acceptor = None
+        self.receivers = dict() # Connection => open receivers
+
+        self.received = 0
+        self.last_received = 0
+        self.last_connections = 0
+        self.peak_connections = 0
+
+    def on_start(self, event):
+        self.acceptor = self.acceptor_class(event.container, self.listen_url.host or "0.0.0.0",
+                                            int(self.listen_url.port))
+        event.container.schedule(1, self)
+
+        if self.stats is None:
+            print("RECEIVE: Listening at {0}".format(self.listen_url))
+
+    def on_link_opening(self, event):
+        event.receiver.target.address = event.receiver.remote_target.address
+
+    def on_link_opened(self, event):
+        if event.link.is_receiver:
+            self.receivers.setdefault(event.connection, list()).append(event.receiver)
+            self.peak_connections = max(self.peak_connections, len(self.receivers))
+
+            self.replenish(event.receiver)
+
+    def replenish(self, receiver):
+        # Each receiver on a connection gets a fair share of the
+        # connection's credit window.  It is topped up when it falls
+        # to half its share.
+
+        share = max(1, self.window // len(self.receivers[receiver.connection]))
+
+        if receiver.credit <= share // 2:
+            receiver.flow(share - receiver.credit)
+
+    def on_link_closed(self, event):
+        receivers = self.receivers.get(event.connection)
+
+        if receivers is not None and event.link in receivers:
+            receivers.remove(event.link)
+
+    def on_connection_closed(self, event):
+        self.receivers.pop(event.connection, None)
+
+    def on_disconnected(self, event):
+        self.receivers.pop(event.connection, None)
+
+    def on_message(self, event):
+        self.received += 1
+        self.replenish(event.receiver)
+
+        if self.received == self.desired:
+            self.acceptor.close()
+
+            for conn in self.receivers:
+                conn.close()
+
+    def on_timer_task(self, event):
+        rate = self.received - self.last_received
+        self.last_received = self.received
+
+        if self.stats is None:
+            if rate or len(self.receivers) != self.last_connections:
+                print("RECEIVE: {0} messages/s, {1} total, {2} connections ({3} peak)".format
+                      (rate, self.received, len(self.receivers), self.peak_connections))
+                sys.stdout.flush()
+
+            self.last_connections = len(self.receivers)
+        else:
+            with self.stats.get_lock():
+                self.stats[0] += rate
+                self.stats[1] += len(self.receivers)
+
+        if not self.acceptor._selectable.is_terminal:
+            event.container.schedule(1, self)
+
+def run_sink(listen_url, desired, window, stats=None, stock_io=False):
+    # The sink's acceptor and selector reach into proton internals, so
+    # they are loaded only in sink mode
+    import sinkio
+
+    handler = SinkHandler(listen_url, desired, window, sinkio.ReusePortAcceptor, stats)
+
+    if stock_io:
+        container = Container(handler)
+    else:
+        container = Container(handler, global_handler=sinkio.SinkIOHandler())
+
+    try:
+        container.run()
+    except KeyboardInterrupt:
+        pass
+
+def run_sink_processes(listen_url, desired, window, processes):
+    # Each process listens on the same port with SO_REUSEPORT, and the
+    # kernel spreads incoming connections across them.  The workers
+    # add to shared counters, and this process prints the totals.  The
+    # kernel's spread is uneven, so the workers run without a message
+    # limit, and this process stops them once the total reaches
+    # desired.
+
+    stats = multiprocessing.Array("q", 2)
+    workers = [multiprocessing.Process(target=run_sink, args=(listen_url, 0, window, stats))
+               for i in range(processes)]
+
+    # Stop the workers on SIGTERM as well as on an interrupt
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    for worker in workers:
+        worker.start()
+
+    print("RECEIVE: Listening at {0} with {1} processes".format(listen_url, processes))
+
+    total = 0
+    last_connections = 0
+
+    try:
+        while any(w.is_alive() for w in workers):
+            time.sleep(1)
+
+            with stats.get_lock():
+                rate, connections = stats[0], stats[1]
+                stats[0], stats[1] = 0, 0
+
+            total += rate
+
+            if rate or connections != last_connections:
+                print("RECEIVE: {0} messages/s, {1} total, {2} connections".format(rate, total, connections))
+                sys.stdout.flush()
+
+            last_connections = connections
+
+            if desired and total >= desired:
+                break
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+usage = """Usage: receive.py [--sink [--credit <n>] [--processes <n>]] <connection-url> <address> [<message-count>]"""
+
 def main():
     try:
-        listen_url, address = sys.argv[1:3]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["sink", "credit=", "processes="])
+        opts = dict((name, int(value) if value else True) for name, value in opts)
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+
+    try:
+        listen_url, address = args[0:2]
     except ValueError:
-        sys.exit("Usage: receive.py <connection-url> <address> [<message-count>]")
+        sys.exit(usage)
 
     try:
-        desired = int(sys.argv[3])
+        desired = int(args[2])
     except (IndexError, ValueError):
         desired = 0
 
+    if "--sink" in opts:
+        window = opts.get("--credit", 100)
+        processes = opts.get("--processes", 1)
+
+        if window < 1 or processes < 1:
+            sys.exit(usage)
+
+        import sinkio
+
+        try:
+            sinkio.check_version()
+        except Exception as e:
+            sys.exit("RECEIVE: {0}".format(e))
+
+        if processes == 1:
+            run_sink(listen_url, desired, window)
+        else:
+            run_sink_processes(listen_url, desired, window, processes)
+
+        return
+
     handler = ReceiveHandler(listen_url, address, desired)
     container = Container(handler)
     container.run()
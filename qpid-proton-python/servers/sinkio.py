@@ -0,0 +1,181 @@
+#!/usr/bin/python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# I/O pieces for the sink mode of receive.py.  They reach into
+# proton's Python I/O internals, so only sink mode uses them, and they
+# apply to one container without changing proton for anyone else.
+# They are enabled only for the python-qpid-proton releases they were
+# tested with, first to last.
+
+import selectors
+import socket
+import time
+
+from proton import VERSION
+from proton._io import IO
+from proton.handlers import IOHandler
+from proton._reactor import Acceptor
+
+TESTED_VERSIONS = (0, 40), (0, 40)
+
+def check_version():
+    first, last = TESTED_VERSIONS
+
+    if not first <= VERSION[:2] <= last:
+        raise Exception("Sink mode relies on proton internals and was tested only with python-qpid-proton "
+                        "{0}.{1} to {2}.{3}, not {4}.{5}".format(*(first + last + VERSION[:2])))
+
+class ReusePortAcceptor(Acceptor):
+    # Proton's acceptor listens with a backlog of 10 and without
+    # SO_REUSEPORT.  This one sets up its own listening socket so
+    # several processes can share a port, and a storm of connects
+    # isn't dropped at the backlog.  Accepted connections are handled
+    # as usual.
+
+    def __init__(self, container, host, port, backlog=1024):
+        self._ssl_domain = None
+        self._reactor = container
+        self._handler = None
+
+        family, type, proto, _, addr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM, 0,
+                                                          socket.AI_PASSIVE)[0]
+
+        sock = socket.socket(family, type, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setblocking(False)
+        sock.bind(addr)
+        sock.listen(backlog)
+
+        selectable = container.selectable(handler=self, delegate=sock)
+        selectable.reading = True
+        selectable._transport = None
+
+        self._selectable = selectable
+        container.update(selectable)
+
+class SinkSelector(IO.Selector):
+    # Proton's selector passes every socket to select() on each pass
+    # of the I/O loop, and select() can't watch file descriptors above
+    # 1024.  This one keeps an epoll (or poll) registration in step
+    # with the reading and writing sets as they change, so a wait
+    # costs time in the number of ready sockets.
+
+    def __init__(self):
+        super(SinkSelector, self).__init__()
+
+        self._poller = selectors.DefaultSelector()
+        self._registered = dict() # Selectable => (file descriptor, events)
+        self._owners = dict() # File descriptor => selectable
+
+    def add(self, selectable):
+        super(SinkSelector, self).add(selectable)
+        self._sync(selectable)
+
+    def update(self, selectable):
+        super(SinkSelector, self).update(selectable)
+        self._sync(selectable)
+
+    def remove(self, selectable):
+        super(SinkSelector, self).remove(selectable)
+        self._unregister(selectable)
+
+    def _sync(self, selectable):
+        events = 0
+
+        if selectable in self._reading:
+            events |= selectors.EVENT_READ
+
+        if selectable in self._writing:
+            events |= selectors.EVENT_WRITE
+
+        fd, current = self._registered.get(selectable, (None, 0))
+
+        if events == current:
+            return
+
+        if events == 0:
+            self._unregister(selectable)
+            return
+
+        if fd is None:
+            fd = selectable.fileno()
+
+            if fd < 0:
+                return
+
+            owner = self._owners.get(fd)
+
+            if owner is not None:
+                # The descriptor was closed and reused before proton
+                # removed its old selectable
+                self._unregister(owner)
+
+            self._poller.register(fd, events, selectable)
+            self._owners[fd] = selectable
+        else:
+            self._poller.modify(fd, events, selectable)
+
+        self._registered[selectable] = fd, events
+
+    def _unregister(self, selectable):
+        fd, _ = self._registered.pop(selectable, (None, 0))
+
+        if fd is None:
+            return
+
+        del self._owners[fd]
+
+        try:
+            self._poller.unregister(fd)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def select(self, timeout):
+        now = time.time()
+
+        if self._deadline is not None:
+            wait = max(0, self._deadline - now)
+            timeout = wait if timeout is None else max(0, min(timeout, wait))
+
+        readable, writable = list(), list()
+
+        for key, events in self._poller.select(timeout):
+            if events & selectors.EVENT_READ:
+                readable.append(key.data)
+
+            if events & selectors.EVENT_WRITE:
+                writable.append(key.data)
+
+        # Deadlines are checked the way proton does
+        now = time.time()
+        expired = [x for x in self._selectables if x.deadline and now > x.deadline]
+
+        self._deadline = None
+        self.update_deadline()
+
+        return readable, writable, expired
+
+class SinkIOHandler(IOHandler):
+    # Pass as the container's global handler to use SinkSelector
+    # instead of the select() loop
+
+    def __init__(self):
+        super(SinkIOHandler, self).__init__()
+        self._selector = SinkSelector()
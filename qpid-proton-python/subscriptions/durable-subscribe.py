@@ -20,7 +20,12 @@
 
 from __future__ import print_function
 
+import getopt
+import json
+import os
 import sys
+import tempfile
+import time
 
 from proton import Terminus
 from proton.handlers import MessagingHandler
@@ -70,22 +75,201 @@ class SubscriptionOptions(ReceiverOption):
         # Don't expire the source
         receiver.source.expiry_policy = Terminus.EXPIRE_NEVER
 
+class CheckpointSubscribeHandler(MessagingHandler):
+    # Processes messages in batches.  After each batch, the batch's
+    # message IDs are written to a local checkpoint file, and only then
+    # are its deliveries accepted.  A subscriber that crashes gets the
+    # unaccepted messages again, at most one batch, and the message IDs
+    # in the checkpoint let it skip any it already processed.  This
+    # relies on message IDs that are unique across senders and runs,
+    # like those from send.py --count.
+
+    def __init__(self, conn_url, address, desired, container_id, link_name, batch_size,
+                 checkpoint_file, flush_interval=0.1):
+        super(CheckpointSubscribeHandler, self).__init__(prefetch=batch_size * 2, auto_accept=False)
+
+        self.conn_url = conn_url
+        self.address = address
+
+        self.desired = desired
+        self.container_id = container_id
+        self.link_name = link_name
+        self.batch_size = batch_size
+        self.checkpoint_file = checkpoint_file
+        self.flush_interval = flush_interval
+
+        self.checkpoint_ids = set()
+
+        self.batch = list() # Deliveries to accept after the next checkpoint
+        self.batch_ids = list()
+        self.timer = None
+
+        self.processed = 0
+        self.replayed = 0
+        self.start_time = None
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_file) as f:
+                checkpoint = json.load(f)
+        except IOError:
+            return
+
+        if checkpoint["subscription"] != [self.container_id, self.link_name]:
+            raise Exception("The checkpoint file is for another subscription")
+
+        self.checkpoint_ids = set(checkpoint["last_batch_ids"])
+
+        print("SUBSCRIBE: Resuming with {0} message IDs from the last batch".format(len(self.checkpoint_ids)))
+
+    def write_checkpoint(self):
+        # Write to a temporary file and rename it over the old one, so
+        # a crash leaves either the old checkpoint or the new one
+
+        checkpoint = {
+            "subscription": [self.container_id, self.link_name],
+            "last_batch_ids": self.batch_ids,
+        }
+
+        dir = os.path.dirname(os.path.abspath(self.checkpoint_file))
+        fd, temp = tempfile.mkstemp(dir=dir, prefix=".checkpoint-")
+
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(checkpoint, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(temp, self.checkpoint_file)
+        except:
+            os.unlink(temp)
+            raise
+
+    def on_start(self, event):
+        self.load_checkpoint()
+
+        conn = event.container.connect(self.conn_url)
+
+        event.container.create_receiver(conn, self.address, name=self.link_name,
+                                        options=SubscriptionOptions())
+
+    def on_link_opened(self, event):
+        print("SUBSCRIBE: Opened receiver for source address '{0}'".format
+              (event.receiver.source.address))
+
+        self.start_time = time.time()
+
+    def on_message(self, event):
+        if self.desired and self.processed == self.desired:
+            # Prefetched after the last desired message.  It is
+            # released when the receiver detaches.
+            return
+
+        message = event.message
+        message_id = str(message.id) if message.id is not None else None
+
+        if message_id is not None and message_id in self.checkpoint_ids:
+            # Processed before a crash, but not yet accepted
+            self.replayed += 1
+            self.accept(event.delivery)
+            return
+
+        self.process(message)
+
+        self.batch.append(event.delivery)
+
+        if message_id is not None:
+            self.batch_ids.append(message_id)
+
+        if self.processed == self.desired:
+            self.commit()
+
+            event.receiver.detach()
+            event.connection.close()
+        elif len(self.batch) >= self.batch_size:
+            self.commit()
+        elif self.timer is None:
+            self.timer = event.container.schedule(self.flush_interval, self)
+
+    def process(self, message):
+        self.processed += 1
+
+    def on_timer_task(self, event):
+        self.timer = None
+        self.commit()
+
+    def commit(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.batch:
+            return
+
+        self.write_checkpoint()
+
+        for delivery in self.batch:
+            self.accept(delivery)
+
+        self.checkpoint_ids = set(self.batch_ids)
+
+        del self.batch[:]
+        del self.batch_ids[:]
+
+    def print_summary(self):
+        duration = time.time() - self.start_time if self.start_time else 0
+
+        print("SUBSCRIBE: Processed {0} messages in {1:.3f} s ({2:.0f} messages/s)".format
+              (self.processed, duration, self.processed / duration if duration else 0))
+
+        if self.replayed:
+            print("SUBSCRIBE: Skipped {0} replayed messages".format(self.replayed))
+
+usage = """Usage: durable-subscribe.py [--batch <n> [--checkpoint <file>]] <connection-url> <address> [<message-count>]"""
+
 def main():
     try:
-        conn_url, address = sys.argv[1:3]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["batch=", "checkpoint="])
+        opts = dict(opts)
+        batch_size = int(opts.get("--batch", 0))
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+
+    try:
+        conn_url, address = args[0:2]
     except ValueError:
-        sys.exit("Usage: durable-subscribe.py <connection-url> <address> [<message-count>]")
+        sys.exit(usage)
 
     try:
-        desired = int(sys.argv[3])
+        desired = int(args[2])
     except (IndexError, ValueError):
         desired = 0
 
+    # Set the container ID and receiver name to stable values.
+    # Together they identify the subscription.
+    container_id = "client-1"
+    link_name = "sub-1"
+
+    if batch_size > 0:
+        checkpoint_file = opts.get("--checkpoint", "{0}-{1}.checkpoint".format(container_id, link_name))
+
+        handler = CheckpointSubscribeHandler(conn_url, address, desired, container_id, link_name,
+                                             batch_size, checkpoint_file)
+        container = Container(handler)
+        container.container_id = container_id
+
+        try:
+            container.run()
+        finally:
+            handler.print_summary()
+
+        return
+
     handler = SubscribeHandler(conn_url, address, desired)
     container = Container(handler)
 
     # Set the container ID to a stable value, such as "client-1"
-    container.container_id = "client-1"
+    container.container_id = container_id
 
     container.run()
 
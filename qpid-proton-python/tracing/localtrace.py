@@ -0,0 +1,238 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+# A small tracer for the examples that needs no tracing agent.
+#
+# Sampling is decided when a trace starts, either with a fixed
+# probability or by rate limiting.  Sampled span contexts travel in
+# message annotations, so a receiver continues the sender's trace.
+# Finished spans are queued and written by a background thread to a
+# JSON-lines file in batches, and unsampled spans cost almost nothing.
+
+import collections
+import json
+import random
+import threading
+import time
+
+CONTEXT_ANNOTATION = "x-opt-trace-context"
+
+class ProbabilisticSampler:
+    def __init__(self, rate):
+        self.rate = rate
+
+    def sample(self):
+        return random.random() < self.rate
+
+class RateLimitingSampler:
+    # A token bucket allowing max_per_second traces, with bursts of up
+    # to one second's worth
+
+    def __init__(self, max_per_second):
+        self.max_per_second = max_per_second
+        self.tokens = max_per_second
+        self.last_time = time.time()
+
+    def sample(self):
+        now = time.time()
+
+        self.tokens = min(self.max_per_second, self.tokens + (now - self.last_time) * self.max_per_second)
+        self.last_time = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+
+        return False
+
+class SpanContext:
+    __slots__ = ("trace_id", "span_id")
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+    def encode(self):
+        # In the form of a W3C traceparent header
+        return "00-{0:032x}-{1:016x}-01".format(self.trace_id, self.span_id)
+
+    @staticmethod
+    def decode(value):
+        try:
+            version, trace_id, span_id, flags = value.split("-")
+            return SpanContext(int(trace_id, 16), int(span_id, 16))
+        except (AttributeError, ValueError):
+            return None
+
+class Span:
+    __slots__ = ("tracer", "context", "parent_id", "name", "start_time", "tags")
+
+    def __init__(self, tracer, context, parent_id, name):
+        self.tracer = tracer
+        self.context = context
+        self.parent_id = parent_id
+        self.name = name
+        self.start_time = time.time()
+        self.tags = dict()
+
+    def set_tag(self, name, value):
+        self.tags[name] = value
+
+    def finish(self):
+        self.tracer.exporter.export({
+            "service": self.tracer.service,
+            "name": self.name,
+            "trace_id": "{0:032x}".format(self.context.trace_id),
+            "span_id": "{0:016x}".format(self.context.span_id),
+            "parent_id": "{0:016x}".format(self.parent_id) if self.parent_id else None,
+            "start": self.start_time,
+            "duration": time.time() - self.start_time,
+            "tags": self.tags,
+        })
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.finish()
+
+class _UnsampledSpan:
+    context = None
+
+    def set_tag(self, name, value):
+        pass
+
+    def finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_unsampled_span = _UnsampledSpan()
+
+class Tracer:
+    def __init__(self, service, sampler, exporter):
+        self.service = service
+        self.sampler = sampler
+        self.exporter = exporter
+
+    def start_span(self, name, parent=None):
+        """Start a span.  A span with a parent context is always
+        sampled, since its trace was.  Otherwise the sampler
+        decides."""
+
+        if parent is None:
+            if not self.sampler.sample():
+                return _unsampled_span
+
+            context = SpanContext(random.getrandbits(128), random.getrandbits(64))
+            return Span(self, context, None, name)
+
+        context = SpanContext(parent.trace_id, random.getrandbits(64))
+        return Span(self, context, parent.span_id, name)
+
+    def inject(self, span, message):
+        if span.context is None:
+            return
+
+        if message.annotations is None:
+            message.annotations = dict()
+
+        message.annotations[CONTEXT_ANNOTATION] = span.context.encode()
+
+    def extract(self, message):
+        if not message.annotations:
+            return None
+
+        return SpanContext.decode(message.annotations.get(CONTEXT_ANNOTATION))
+
+    def close(self):
+        self.exporter.close()
+
+def create_tracer(service, trace_file, sample=1.0, rate_limit=None):
+    """Create a tracer writing to trace_file and sampling a fraction
+    of traces, or at most rate_limit traces per second"""
+
+    if rate_limit is not None:
+        sampler = RateLimitingSampler(rate_limit)
+    else:
+        sampler = ProbabilisticSampler(sample)
+
+    return Tracer(service, sampler, JsonLinesExporter(trace_file))
+
+class JsonLinesExporter:
+    # Spans are appended to a queue and written by a background thread
+    # every flush_interval seconds, or sooner once batch_size are
+    # waiting.  If the writer falls behind by max_queue spans, new
+    # spans are dropped and counted.
+
+    def __init__(self, path, batch_size=512, flush_interval=1.0, max_queue=65536):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+
+        self.queue = collections.deque()
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+        self.exported = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def export(self, span):
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return
+
+        self.queue.append(span)
+
+        if len(self.queue) >= self.batch_size:
+            self.wakeup.set()
+
+    def run(self):
+        with open(self.path, "a") as f:
+            while True:
+                self.wakeup.wait(self.flush_interval)
+                self.wakeup.clear()
+
+                stopping = self.stopping
+                lines = list()
+
+                while self.queue:
+                    lines.append(json.dumps(self.queue.popleft()))
+
+                if lines:
+                    f.write("\n".join(lines) + "\n")
+                    f.flush()
+
+                    self.exported += len(lines)
+
+                if stopping:
+                    break
+
+    def close(self):
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
@@ -20,21 +20,21 @@
 
 from __future__ import print_function
 
+import getopt
 import sys
 
 from proton.handlers import MessagingHandler
 from proton.reactor import Container
 
-from proton.tracing import init_tracer
-
-tracer = init_tracer("receive")
+import localtrace
 
 class ReceiveHandler(MessagingHandler):
-    def __init__(self, conn_url, address, desired):
+    def __init__(self, conn_url, address, desired, tracer=None):
         super(ReceiveHandler, self).__init__()
 
         self.conn_url = conn_url
         self.address = address
+        self.tracer = tracer
 
         self.desired = desired
         self.received = 0
@@ -50,7 +50,17 @@ class ReceiveHandler(MessagingHandler):
     def on_message(self, event):
         message = event.message
 
-        print("RECEIVE: Received message '{0}'".format(message.body))
+        if self.tracer is None:
+            # Traced by proton's Jaeger integration
+            print("RECEIVE: Received message '{0}'".format(message.body))
+        else:
+            # Continue the sender's trace if the message carries one
+            parent = self.tracer.extract(message)
+
+            with self.tracer.start_span("receive", parent=parent) as span:
+                span.set_tag("address", self.address)
+
+                print("RECEIVE: Received message '{0}'".format(message.body))
 
         self.received += 1
 
@@ -58,20 +68,47 @@ class ReceiveHandler(MessagingHandler):
             event.receiver.close()
             event.connection.close()
 
+usage = """Usage: receive.py [--trace-file <file> [--sample <rate> | --rate-limit <traces-per-second>]] <connection-url> <address> [<message-count>]"""
+
 def main():
     try:
-        conn_url, address = sys.argv[1:3]
-    except ValueError:
-        sys.exit("Usage: receive.py <connection-url> <address> [<message-count>]")
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["trace-file=", "sample=", "rate-limit="])
+        opts = dict(opts)
+        conn_url, address = args[0:2]
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
 
     try:
-        desired = int(sys.argv[3])
+        desired = int(args[2])
     except (IndexError, ValueError):
         desired = 0
 
-    handler = ReceiveHandler(conn_url, address, desired)
+    if "--trace-file" not in opts:
+        from proton.tracing import init_tracer
+
+        init_tracer("receive")
+
+        handler = ReceiveHandler(conn_url, address, desired)
+        container = Container(handler)
+        container.run()
+
+        return
+
+    try:
+        sample = float(opts.get("--sample", 1.0))
+        rate_limit = float(opts["--rate-limit"]) if "--rate-limit" in opts else None
+    except ValueError:
+        sys.exit(usage)
+
+    tracer = localtrace.create_tracer("receive", opts["--trace-file"], sample, rate_limit)
+
+    handler = ReceiveHandler(conn_url, address, desired, tracer)
     container = Container(handler)
-    container.run()
+
+    try:
+        container.run()
+    finally:
+        tracer.close()
 
 if __name__ == "__main__":
     try:
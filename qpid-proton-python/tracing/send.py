@@ -20,23 +20,22 @@
 
 from __future__ import print_function
 
+import getopt
 import sys
 
 from proton import Message
 from proton.handlers import MessagingHandler
 from proton.reactor import Container
 
-from opentracing import tags
-from proton.tracing import init_tracer
-
-tracer = init_tracer("send")
+import localtrace
 
 class SendHandler(MessagingHandler):
-    def __init__(self, conn_url, address, message_body):
+    def __init__(self, conn_url, address, message_body, tracer=None):
         super(SendHandler, self).__init__()
 
         self.conn_url = conn_url
         self.address = address
+        self.tracer = tracer
 
         try:
             self.message_body = unicode(message_body)
@@ -53,20 +52,27 @@ class SendHandler(MessagingHandler):
 
     def on_sendable(self, event):
         message = Message(self.message_body)
-        event.sender.send(message)
+
+        if self.tracer is None:
+            # Traced by proton's Jaeger integration
+            event.sender.send(message)
+        else:
+            with self.tracer.start_span("send") as span:
+                span.set_tag("address", self.address)
+
+                self.tracer.inject(span, message)
+                event.sender.send(message)
 
         print("SEND: Sent message '{0}'".format(message.body))
 
         event.sender.close()
         event.connection.close()
 
-def main():
-    try:
-        conn_url, address, message_body = sys.argv[1:4]
-    except ValueError:
-        sys.exit("Usage: send.py <connection-url> <address> <message-body>")
+def run_with_jaeger(handler):
+    from opentracing import tags
+    from proton.tracing import init_tracer
 
-    handler = SendHandler(conn_url, address, message_body)
+    tracer = init_tracer("send")
     container = Container(handler)
 
     with tracer.start_active_span("run") as scope:
@@ -75,6 +81,36 @@ def main():
 
         container.run()
 
+usage = """Usage: send.py [--trace-file <file> [--sample <rate> | --rate-limit <traces-per-second>]] <connection-url> <address> <message-body>"""
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["trace-file=", "sample=", "rate-limit="])
+        opts = dict(opts)
+        conn_url, address, message_body = args[0:3]
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+
+    if "--trace-file" not in opts:
+        run_with_jaeger(SendHandler(conn_url, address, message_body))
+        return
+
+    try:
+        sample = float(opts.get("--sample", 1.0))
+        rate_limit = float(opts["--rate-limit"]) if "--rate-limit" in opts else None
+    except ValueError:
+        sys.exit(usage)
+
+    tracer = localtrace.create_tracer("send", opts["--trace-file"], sample, rate_limit)
+
+    handler = SendHandler(conn_url, address, message_body, tracer)
+    container = Container(handler)
+
+    try:
+        container.run()
+    finally:
+        tracer.close()
+
 if __name__ == "__main__":
     try:
         main()